@@ -0,0 +1,40 @@
+# Benchmark for duplicate lookups in the post history
+# Usage: python bench_history.py
+# Lookup cost should stay roughly flat as the number of logged posts grows
+
+import os
+import csv
+import time
+import tempfile
+from history import CSV_HEADER, CsvHistory, SqliteHistory
+
+LOOKUPS = 1000
+
+
+def make_csv(path, size):
+    with open(path, 'w', newline='') as cache:
+        wr = csv.writer(cache)
+        wr.writerow(CSV_HEADER)
+        for i in range(size):
+            wr.writerow(['p' + str(i), '01/01/2019 00:00:00', 'https://example.com/' + str(i)])
+
+
+def time_lookups(history, size):
+    start = time.perf_counter()
+    for i in range(LOOKUPS):
+        # Half of the lookups hit, half miss
+        history.contains('p' + str((i * 7919) % (size * 2)))
+    return (time.perf_counter() - start) / LOOKUPS * 1000000
+
+
+with tempfile.TemporaryDirectory() as folder:
+    print('History size   CSV (us/lookup)   SQLite (us/lookup)')
+    for size in (1000, 10000, 100000, 500000):
+        csv_path = os.path.join(folder, 'cache-' + str(size) + '.csv')
+        db_path = os.path.join(folder, 'cache-' + str(size) + '.db')
+        make_csv(csv_path, size)
+        csv_history = CsvHistory(csv_path)
+        sqlite_history = SqliteHistory(db_path)
+        sqlite_history.import_csv(csv_path)
+        print('%12d   %15.2f   %18.2f' % (size, time_lookups(csv_history, size), time_lookups(sqlite_history, size)))
+        sqlite_history.close()
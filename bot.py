@@ -0,0 +1,642 @@
+import time
+import asyncio
+import concurrent.futures
+import metrics
+import praw
+import tweepy
+from mastodon import Mastodon
+from mastodon import MastodonUnauthorizedError
+from mastodon import MastodonRatelimitError
+from getmedia import get_media_files
+from getmedia import delete_media_file
+from getmedia import keep_media_file
+from getmedia import get_metadata_stats
+from getmedia import get_twitter_media
+from getmedia import get_mastodon_media
+from getmedia import get_file_mime_type
+from getmedia import get_gallery_urls
+from getmedia import get_gallery_item
+from getmedia import get_attachments
+from getmedia import MediaNotFoundError
+from twitterupload import upload_video
+from mastodonupload import upload_media
+from history import NegativeCache
+from workqueue import new_job
+from workqueue import get_submission
+from workqueue import fail_job
+from workqueue import get_media_list
+
+# Number of seconds before posts skipped for a spoiler tag or being stickied are checked again
+FILTER_RECHECK_TIME = 3600
+
+# Function for uploading several attachments at the same time, returns the results in the same order
+
+def upload_all(upload, files):
+    if len(files) == 1:
+        return [upload(files[0])]
+    with concurrent.futures.ThreadPoolExecutor(len(files)) as pool:
+        return list(pool.map(upload, files))
+
+# Rate limit of one platform, read from the headers of its responses
+
+class RateLimit:
+
+    def __init__(self):
+        # Requests left until the limit resets, None until a response has been seen
+        self.remaining = None
+        self.reset = 0
+
+    def update(self, remaining, reset):
+        if remaining is None or reset is None:
+            return
+        self.remaining = int(remaining)
+        self.reset = float(reset)
+
+    # Twitter only sends rate limit headers for some endpoints
+    def update_twitter(self, response):
+        if response is not None:
+            self.update(response.headers.get('x-rate-limit-remaining'), response.headers.get('x-rate-limit-reset'))
+
+    # Marks the limit as used up, until the reset time or for 15 minutes if it isn't known
+    def block(self, reset):
+        self.remaining = 0
+        if reset:
+            # Wait at least a minute, in case the clocks don't match
+            self.reset = max(float(reset), time.time() + 60)
+        else:
+            self.reset = time.time() + 900
+        print('[WARN] Rate limit reached, waiting until', time.strftime('%H:%M:%S', time.localtime(self.reset)))
+
+    # Earliest time the next post can be made without running out of requests before the limit resets
+    def next_time(self, last_post_time):
+        now = time.time()
+        if self.remaining is None or self.reset <= now:
+            return 0
+        if self.remaining <= 0:
+            return self.reset
+        # Spread what is left evenly until the reset
+        return last_post_time + (self.reset - now) / self.remaining
+
+# One bot definition: a subreddit, its filters and post history, and the Twitter and Mastodon accounts it posts to
+# Everything else (the Reddit connection, media downloads and caches) is shared between all bots in the process
+
+class Bot:
+
+    def __init__(self, name, settings, history, queue):
+        self.name = name
+        self.settings = settings
+        self.history = history
+        # Durable queue of posts on their way through the resolve, transcode, post and log stages
+        self.queue = queue
+        self.twitter = None
+        self.twitter_username = None
+        self.twitter_keys = None
+        self.mastodon = None
+        self.masto_username = None
+        self.mastodon_token = None
+        # Reddit posts that were already filtered, queued or posted
+        self.negative_cache = NegativeCache()
+        # Posts whose media is held by this process, anything else in the queue was left over from before a restart
+        self.active = set()
+        # Post ID -> [job, task] for media being prepared in the background, kept between cycles so slow media doesn't hold up the cycle
+        self.preparing = {}
+        # Time of the last social media post, used to space out posts
+        self.last_post_time = 0
+        # Whether a post is ready but waiting for the delay or a rate limit
+        self.waiting = False
+        # Task preparing the media for the next post, if the post could be made but its media isn't ready yet
+        self.pending_media = None
+        self.twitter_limit = RateLimit()
+        self.mastodon_limit = RateLimit()
+
+    def connect_twitter(self):
+        consumer_key, consumer_secret, access_token, access_token_secret = self.twitter_keys
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, access_token_secret)
+        return tweepy.API(auth)
+
+    def connect_mastodon(self):
+        # Rate limits are tracked by the bot, instead of Mastodon.py sleeping inside a request
+        return Mastodon(
+            access_token=self.mastodon_token,
+            api_base_url='https://' + self.settings.mastodon_instance_domain,
+            ratelimit_method='throw'
+        )
+
+    # Logs into Twitter and makes sure authentication is working, returns the account's username
+    def login_twitter(self, consumer_key, consumer_secret, access_token, access_token_secret):
+        self.twitter_keys = (consumer_key, consumer_secret, access_token, access_token_secret)
+        self.twitter = self.connect_twitter()
+        self.twitter_username = self.twitter.me().screen_name
+        return self.twitter_username
+
+    # Logs into Mastodon with an access token or the path of a secret file, returns the account's username
+    def login_mastodon(self, access_token):
+        self.mastodon_token = access_token
+        self.mastodon = self.connect_mastodon()
+        self.masto_username = self.mastodon.account_verify_credentials()['username']
+        return self.masto_username
+
+    # The Twitter and Mastodon clients are created once at startup, and only created again after an authentication error
+    def refresh_twitter(self):
+        print('[WARN] Logging into Twitter again...')
+        try:
+            self.twitter = self.connect_twitter()
+        except BaseException as e:
+            print('[EROR] Error while logging into Twitter:', str(e))
+
+    def refresh_mastodon(self):
+        print('[WARN] Logging into Mastodon again...')
+        try:
+            self.mastodon = self.connect_mastodon()
+        except BaseException as e:
+            print('[EROR] Error while logging into Mastodon:', str(e))
+
+    def get_hashtag_string(self):
+        # Create string of hashtags
+        hashtag_string = ''
+        if self.settings.hashtags:
+            for x in self.settings.hashtags:
+                # Add hashtag to string, followed by a space for the next one
+                hashtag_string += '#' + x + ' '
+        return hashtag_string
+
+    def get_twitter_caption(self, submission):
+        hashtag_string = self.get_hashtag_string()
+        # Set the Twitter max title length for 280, minus the length of the shortlink and hashtags, minus one for the space between title and shortlink
+        twitter_max_title_length = 280 - len(submission.shortlink) - len(hashtag_string) - 1
+        # Create contents of the Twitter post
+        if len(submission.title) < twitter_max_title_length:
+            twitter_caption = submission.title + ' ' + hashtag_string + submission.shortlink
+        else:
+            twitter_caption = submission.title[:twitter_max_title_length] + '... ' + hashtag_string + submission.shortlink
+        return twitter_caption
+
+    def get_mastodon_caption(self, submission):
+        hashtag_string = self.get_hashtag_string()
+        # Set the Mastodon max title length for 500, minus the length of the shortlink and hashtags, minus one for the space between title and shortlink
+        mastodon_max_title_length = 500 - len(submission.shortlink) - len(hashtag_string) - 1
+        # Create contents of the Mastodon post
+        if len(submission.title) < mastodon_max_title_length:
+            mastodon_caption = submission.title + ' ' + hashtag_string + submission.shortlink
+        else:
+            mastodon_caption = submission.title[:mastodon_max_title_length] + '... ' + hashtag_string + submission.shortlink
+        return mastodon_caption
+
+    # Applies this bot's filters to submissions fetched from Reddit, and returns the ones that can be posted
+    def get_reddit_posts(self, submissions):
+        settings = self.settings
+        negative_cache = self.negative_cache
+        post_dict = {}
+        for submission in submissions:
+            if negative_cache.check(submission.id):
+                # Posts that were already filtered, queued or posted are skipped quietly
+                continue
+            elif (submission.over_18 and settings.nsfw_posts_allowed is False):
+                # Skip over NSFW posts if they are disabled in the config file
+                print('[ OK ] Skipping', submission.id, 'because it is marked as NSFW')
+                negative_cache.add(submission.id, 'NSFW')
+                metrics.count('posts_filtered', reason='NSFW', bot=self.name)
+                continue
+            elif (submission.is_self and settings.self_posts_allowed is False):
+                # Skip over NSFW posts if they are disabled in the config file
+                print('[ OK ] Skipping', submission.id, 'because it is a self post')
+                negative_cache.add(submission.id, 'self post')
+                metrics.count('posts_filtered', reason='self post', bot=self.name)
+                continue
+            elif (submission.spoiler and settings.spoilers_allowed is False):
+                # Skip over posts marked as spoilers if they are disabled in the config file
+                print('[ OK ] Skipping', submission.id, 'because it is marked as a spoiler')
+                # Spoiler tags can be removed, so check again later
+                negative_cache.add(submission.id, 'spoiler', FILTER_RECHECK_TIME)
+                metrics.count('posts_filtered', reason='spoiler', bot=self.name)
+                continue
+            elif (submission.stickied):
+                print('[ OK ] Skipping', submission.id, 'because it is stickied')
+                # Posts can be unstickied, so check again later
+                negative_cache.add(submission.id, 'stickied', FILTER_RECHECK_TIME)
+                metrics.count('posts_filtered', reason='stickied', bot=self.name)
+                continue
+            else:
+                # Create dict
+                post_dict[submission.id] = submission
+        return post_dict
+
+    # Checks new posts against the post history and the work queue, and adds the rest to the queue
+    def queue_posts(self, post_dict):
+        # Check the whole page of posts at once, before any media is downloaded
+        posted_ids = self.history.find_posted(list(post_dict))
+        queued_ids = self.queue.find_queued(list(post_dict))
+        for post_id in post_dict:
+            if post_id in posted_ids:
+                print('[ OK ] Skipping', post_id, 'because it was already posted')
+                self.negative_cache.add(post_id, 'already posted')
+            elif post_id in queued_ids:
+                self.negative_cache.add(post_id, 'queued')
+            else:
+                self.queue.add(new_job(post_dict[post_id]))
+                self.negative_cache.add(post_id, 'queued')
+
+    # Earliest time the next post can be made, going by the minimum delay and what is left of each platform's rate limit
+    def next_post_time(self):
+        times = [self.last_post_time + self.settings.delay_between_posts]
+        if self.settings.post_to_twitter:
+            times.append(self.twitter_limit.next_time(self.last_post_time))
+        if self.settings.post_to_mastodon:
+            times.append(self.mastodon_limit.next_time(self.last_post_time))
+        return max(times)
+
+    # Picks up the media of a job started before a restart, and sends it back to be downloaded again if any of it is gone
+    def resume_job(self, job):
+        # Files replaced by a converted version are only needed for cleaning up
+        job['replaced_files'] = [f for f in job.get('replaced_files', []) if keep_media_file(f)]
+        files = set(get_media_list(job, 'media_file') + get_media_list(job, 'hd_media_file'))
+        missing = [f for f in files if not keep_media_file(f)]
+        if not missing:
+            return
+        if job['stage'] == 'log':
+            # The post was already made, so there is nothing to download again
+            for field in ('media_file', 'hd_media_file'):
+                if job[field] in missing:
+                    job[field] = None
+            for item in job.get('gallery', []):
+                item[1:] = [None if f in missing else f for f in item[1:]]
+            return
+        print('[WARN] Media for', job['post_id'], 'is missing, downloading it again')
+        for file in files.difference(missing):
+            delete_media_file(file)
+        job['stage'] = 'resolve'
+        job['media_file'] = None
+        job['hd_media_file'] = None
+        job['media_url'] = None
+        job['gallery'] = []
+        self.queue.save(job)
+
+    # Downloads the media for a job, runs in the media pool
+    # Each image in a gallery is downloaded at the same time, and the job only moves on once all of them are done
+    async def download(self, job, media_pool):
+        loop = asyncio.get_event_loop()
+        submission = get_submission(job)
+        urls = await loop.run_in_executor(media_pool, get_gallery_urls, submission, self.settings)
+        if not urls:
+            # Media is downloaded once, and shared between Twitter and Mastodon when the format allows it
+            job['media_file'], job['hd_media_file'] = await loop.run_in_executor(media_pool, get_media_files, submission, self.settings)
+            return
+        print('[ OK ] Downloading', len(urls), 'images from gallery for', job['post_id'])
+        items = [get_gallery_item(submission, url, index) for index, url in enumerate(urls)]
+        results = await asyncio.gather(*[loop.run_in_executor(media_pool, get_media_files, item, self.settings) for item in items], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # The whole gallery is tried again, so the images that did download are cleaned up
+            for result in results:
+                if not isinstance(result, BaseException):
+                    for file in set(f for f in result if f):
+                        delete_media_file(file)
+            # Errors that might go away are raised first, so the gallery is tried again
+            raise next((e for e in errors if not isinstance(e, MediaNotFoundError)), errors[0])
+        job['media_url'] = urls[0]
+        job['media_file'], job['hd_media_file'] = results[0]
+        job['gallery'] = [[url] + list(result) for url, result in zip(urls[1:], results[1:])]
+
+    # Prepares the media for a job, returns False if the post can't be made yet
+    # Downloads run in the media pool and transcoding in the transcode pool, so each stage has its own concurrency
+    async def prepare(self, job, media_pool, transcode_pool):
+        loop = asyncio.get_event_loop()
+        if job['stage'] != 'resolve' and job['post_id'] not in self.active:
+            self.resume_job(job)
+        if job['stage'] == 'resolve':
+            try:
+                with metrics.span('stage', stage='resolve', bot=self.name):
+                    await self.download(job, media_pool)
+            except BaseException as e:
+                print('[EROR] Error while downloading media for', job['post_id'] + ':', str(e))
+                if self.retry_job(job, e):
+                    return False
+            job['stage'] = 'transcode'
+            self.queue.save(job)
+        self.active.add(job['post_id'])
+        if job['stage'] == 'transcode':
+            try:
+                with metrics.span('stage', stage='transcode', bot=self.name):
+                    await loop.run_in_executor(transcode_pool, self.transcode, job)
+            except BaseException as e:
+                print('[EROR] Error while converting media for', job['post_id'] + ':', str(e))
+                if self.retry_job(job, e):
+                    return False
+                self.drop_media(job)
+            job['stage'] = 'post'
+            self.queue.save(job)
+        return True
+
+    # Records a failed download or conversion, returns True if the job will be tried again in a later cycle
+    # Otherwise the post is made without media, instead of being tried forever
+    def retry_job(self, job, error):
+        if fail_job(job, str(error), isinstance(error, MediaNotFoundError)):
+            self.queue.save(job)
+            return True
+        print('[WARN] Giving up on media for', job['post_id'])
+        self.negative_cache.add(job['post_id'], 'media failed')
+        return False
+
+    # Takes the media off a job that will be posted without it, the files are cleaned up once the post is made
+    def drop_media(self, job):
+        files = set(get_media_list(job, 'media_file') + get_media_list(job, 'hd_media_file'))
+        job['replaced_files'] = list(files.union(job.get('replaced_files', [])))
+        job['media_file'] = None
+        job['hd_media_file'] = None
+        job['gallery'] = []
+
+    # Converts downloaded media for the platforms it is posted to, runs in the transcode pool
+    def transcode(self, job):
+        submission = get_submission(job)
+        items = [[job.get('media_url'), job['media_file'], job['hd_media_file']]] + job.get('gallery', [])
+        for index, item in enumerate(items):
+            # Images in a gallery are converted under their own name
+            item_submission = get_gallery_item(submission, item[0], index) if item[0] else submission
+            files = set(f for f in item[1:] if f)
+            if self.settings.post_to_twitter:
+                item[1] = get_twitter_media(item[1], item[2], item_submission, self.settings)
+            if self.settings.post_to_mastodon:
+                item[2] = get_mastodon_media(item[2], item_submission, self.settings)
+            # Files replaced by a converted version are cleaned up with the rest once the post is made
+            job['replaced_files'] = job.get('replaced_files', []) + list(files.difference(item[1:]))
+        job['media_file'], job['hd_media_file'] = items[0][1:]
+        job['gallery'] = items[1:]
+
+    # Uploads one attachment to Twitter, returns its media ID
+    def upload_to_twitter(self, media_file):
+        with metrics.span('upload', platform='twitter'):
+            if media_file.lower().endswith('.mp4'):
+                # Videos are uploaded in chunks
+                return upload_video(self.twitter, media_file)
+            return self.twitter.media_upload(media_file).media_id_string
+
+    # Uploads one attachment to Mastodon, returns the media attachment
+    def upload_to_mastodon(self, hd_media_file):
+        with metrics.span('upload', platform='mastodon'):
+            return upload_media(self.mastodon, hd_media_file, get_file_mime_type(hd_media_file))
+
+    # Posts on Twitter, returns the entry for the post history and whether a tweet was made
+    def post_to_twitter(self, post_id, submission, media_files):
+        media_files = get_attachments(media_files)
+        # Make sure the post contains media, if MediaPostsOnly in config is set to True
+        if not (((self.settings.media_posts_only is True) and media_files) or (self.settings.media_posts_only is False)):
+            print('[WARN] Twitter: Skipping', post_id, 'because non-media posts are disabled or the media file was not found')
+            metrics.count('posts', platform='twitter', result='skipped', bot=self.name)
+            # Log the post anyways
+            return ((post_id, 'Twitter: Skipped because non-media posts are disabled or the media file was not found'), False)
+        try:
+            # Generate post caption
+            caption = self.get_twitter_caption(submission)
+            # Post the tweet
+            if (media_files):
+                print(
+                    '[ OK ] Posting this on Twitter with', len(media_files), 'media attachment(s):', caption)
+                # Attachments are uploaded at the same time, then attached to the tweet
+                media_ids = upload_all(self.upload_to_twitter, media_files)
+                tweet = self.twitter.update_status(status=caption, media_ids=media_ids)
+            else:
+                print('[ OK ] Posting this on Twitter:',caption)
+                tweet = self.twitter.update_status(status=caption)
+            self.twitter_limit.update_twitter(self.twitter.last_response)
+            metrics.count('posts', platform='twitter', result='posted', bot=self.name)
+            # Log the tweet
+            return ((post_id, 'https://twitter.com/' + self.twitter_username + '/status/' + tweet.id_str + '/'), True)
+        except BaseException as e:
+            print('[EROR] Error while posting tweet:', str(e))
+            if isinstance(e, tweepy.TweepError) and e.response is not None:
+                self.twitter_limit.update_twitter(e.response)
+                # Log in again if the access tokens stopped working
+                if e.response.status_code == 401:
+                    self.refresh_twitter()
+                # Wait for the rate limit to reset, codes 88 and 185 are the API and daily tweet limits
+                elif e.response.status_code == 429 or e.api_code in (88, 185):
+                    self.twitter_limit.block(e.response.headers.get('x-rate-limit-reset'))
+            metrics.count('posts', platform='twitter', result='failed', bot=self.name)
+            # Log the post anyways
+            return ((post_id, 'Error while posting tweet: ' + str(e)), False)
+
+    # Posts on Mastodon, returns the entry for the post history and whether a toot was made
+    def post_to_mastodon(self, post_id, submission, hd_media_files):
+        hd_media_files = get_attachments(hd_media_files)
+        # Make sure the post contains media, if MediaPostsOnly in config is set to True
+        if not (((self.settings.media_posts_only is True) and hd_media_files) or (self.settings.media_posts_only is False)):
+            print('[WARN] Mastodon: Skipping', post_id, 'because non-media posts are disabled or the media file was not found')
+            metrics.count('posts', platform='mastodon', result='skipped', bot=self.name)
+            # Log the post anyways
+            return ((post_id, 'Mastodon: Skipped because non-media posts are disabled or the media file was not found'), False)
+        try:
+            # Generate post caption
+            caption = self.get_mastodon_caption(submission)
+            # Post the toot
+            if (hd_media_files):
+                print(
+                    '[ OK ] Posting this on Mastodon with', len(hd_media_files), 'media attachment(s):', caption)
+                # Attachments are uploaded at the same time, then attached to the toot
+                media = upload_all(self.upload_to_mastodon, hd_media_files)
+                # If the post is marked as NSFW on Reddit, force sensitive media warning for images
+                if (submission.over_18 == True):
+                    toot = self.mastodon.status_post(caption, media_ids=media, spoiler_text='NSFW')
+                else:
+                    toot = self.mastodon.status_post(caption, media_ids=media, sensitive=self.settings.mastodon_sensitive_media)
+            else:
+                print('[ OK ] Posting this on Mastodon:', caption)
+                # Add NSFW warning for Reddit posts marked as NSFW
+                if (submission.over_18 == True):
+                    toot = self.mastodon.status_post(caption, spoiler_text='NSFW')
+                else:
+                    toot = self.mastodon.status_post(caption)
+            self.mastodon_limit.update(self.mastodon.ratelimit_remaining, self.mastodon.ratelimit_reset)
+            metrics.count('posts', platform='mastodon', result='posted', bot=self.name)
+            # Log the toot
+            return ((post_id, toot["url"]), True)
+        except BaseException as e:
+            print('[EROR] Error while posting toot:', str(e))
+            # Log in again if the access token stopped working
+            if isinstance(e, MastodonUnauthorizedError):
+                self.refresh_mastodon()
+            # Wait for the rate limit to reset
+            elif isinstance(e, MastodonRatelimitError):
+                self.mastodon_limit.block(self.mastodon.ratelimit_reset)
+            metrics.count('posts', platform='mastodon', result='failed', bot=self.name)
+            # Log the post anyways
+            return ((post_id, 'Error while posting toot: ' + str(e)), False)
+
+    # Posts on one platform, and saves the result right away so the platform isn't posted to again after a restart
+    async def post_platform(self, job, platform, func, submission, media_files):
+        loop = asyncio.get_event_loop()
+        with metrics.span('post', platform=platform, bot=self.name):
+            entry, posted = await loop.run_in_executor(None, func, job['post_id'], submission, media_files)
+        job['results'][platform] = [list(entry), posted]
+        self.queue.save(job)
+        return posted
+
+    # Posts on Twitter and Mastodon at the same time, skipping platforms that were done before a restart
+    async def publish(self, job):
+        submission = get_submission(job)
+        jobs = []
+        if self.settings.post_to_twitter and 'twitter' not in job['results']:
+            jobs.append(self.post_platform(job, 'twitter', self.post_to_twitter, submission, get_media_list(job, 'media_file')))
+        if self.settings.post_to_mastodon and 'mastodon' not in job['results']:
+            jobs.append(self.post_platform(job, 'mastodon', self.post_to_mastodon, submission, get_media_list(job, 'hd_media_file')))
+        results = await asyncio.gather(*jobs)
+        # Skipped and failed posts don't count towards the delay between posts
+        if any(results):
+            self.last_post_time = time.time()
+        job['stage'] = 'log'
+        self.queue.save(job)
+
+    # Saves the results to the post history, cleans up the media, and takes the job off the queue
+    def finish(self, job):
+        # Results from each platform are saved to the post history together
+        post_log = [tuple(entry) for entry, posted in job['results'].values()]
+        if post_log:
+            self.history.log_all(post_log)
+        self.negative_cache.add(job['post_id'], 'posted')
+        # Clean up media files, which can be shared between both platforms
+        for file in set(get_media_list(job, 'media_file') + get_media_list(job, 'hd_media_file')).union(job.get('replaced_files', [])):
+            try:
+                delete_media_file(file)
+            except BaseException as e:
+                print('[EROR] Error while deleting media file:', str(e))
+        self.queue.remove(job)
+        self.active.discard(job['post_id'])
+
+    # Works through every job in the queue, including ones left over from before a restart
+    # Media for every job is prepared in the background, while posts are made in order and only as fast as the delay and rate limits allow
+    # Once the next post has to wait, or its media isn't ready yet, the rest of the posts are left in the queue
+    # This returns without waiting for media, so it never holds up the other bots, and the media is picked up in a later cycle
+    async def run(self, media_pool, transcode_pool):
+        self.waiting = False
+        self.pending_media = None
+        jobs = self.queue.jobs()
+        for job in jobs:
+            if job['post_id'] not in self.preparing and job['retry_at'] <= time.time():
+                self.preparing[job['post_id']] = [job, asyncio.ensure_future(self.prepare(job, media_pool, transcode_pool))]
+        for post_id in [job['post_id'] for job in jobs]:
+            if post_id not in self.preparing:
+                continue
+            # The job being prepared is used, since it has the latest changes
+            job, ready = self.preparing[post_id]
+            if not ready.done():
+                # Posts are made in order, so later posts wait until the media for this one is ready
+                if not self.waiting:
+                    self.pending_media = ready
+                break
+            try:
+                if not ready.result():
+                    # The media will be prepared again once the job can be tried again
+                    del self.preparing[post_id]
+                    continue
+                if job['stage'] == 'post':
+                    # Posts that will be skipped for having no media don't wait
+                    has_content = self.settings.media_posts_only is False or get_media_list(job, 'media_file') or get_media_list(job, 'hd_media_file')
+                    if has_content and (self.waiting or self.next_post_time() > time.time()):
+                        # Posts are made in order, so every later post waits too, but media is still prepared for them
+                        self.waiting = True
+                        continue
+                    await self.publish(job)
+                if job['stage'] == 'log':
+                    with metrics.span('stage', stage='log', bot=self.name):
+                        self.finish(job)
+                del self.preparing[post_id]
+            except BaseException as e:
+                print('[EROR] Error while posting', job['post_id'], 'for', self.name + ':', str(e))
+                self.preparing.pop(post_id, None)
+
+# Fetches posts from Reddit for every bot, with one request per subreddit no matter how many bots follow it
+
+class RedditFetcher:
+
+    def __init__(self, reddit_agent, reddit_client_secret):
+        print('[ OK ] Setting up connection with Reddit...')
+        self.reddit = praw.Reddit(
+            user_agent='Tootbot',
+            client_id=reddit_agent,
+            client_secret=reddit_client_secret)
+        # Streams of new submissions for subreddits where ListingMode is set to 'new', kept between cycles
+        self.streams = {}
+
+    def get_new_submissions(self, subreddit):
+        # The stream only returns submissions it hasn't returned before, and pauses once there are no new ones
+        if subreddit not in self.streams:
+            self.streams[subreddit] = self.reddit.subreddit(subreddit).stream.submissions(pause_after=0)
+        submissions = []
+        try:
+            for submission in self.streams[subreddit]:
+                if submission is None:
+                    break
+                submissions.append(submission)
+        except BaseException:
+            # A stream stops for good after an error, so a new one is started in the next cycle
+            del self.streams[subreddit]
+            raise
+        return submissions
+
+    # Returns a dict of bot -> list of submissions
+    def get_submissions(self, bots):
+        print('[ OK ] Getting posts from Reddit...')
+        # Bots looking at the same subreddit share one request, using the largest post limit among them
+        hot_limits = {}
+        new_subreddits = set()
+        for bot in bots:
+            subreddit = bot.settings.subreddit_to_monitor
+            if bot.settings.listing_mode == 'new':
+                new_subreddits.add(subreddit)
+            else:
+                hot_limits[subreddit] = max(hot_limits.get(subreddit, 0), bot.settings.post_limit)
+        listings = {}
+        for subreddit in hot_limits:
+            listings[('hot', subreddit)] = list(self.reddit.subreddit(subreddit).hot(limit=hot_limits[subreddit]))
+        for subreddit in new_subreddits:
+            listings[('new', subreddit)] = self.get_new_submissions(subreddit)
+        submissions = {}
+        for bot in bots:
+            limit = bot.settings.post_limit
+            if bot.settings.listing_mode == 'new':
+                # Submissions come oldest first, only the newest ones up to the post limit are used
+                submissions[bot] = listings[('new', bot.settings.subreddit_to_monitor)][-limit:]
+            else:
+                submissions[bot] = listings[('hot', bot.settings.subreddit_to_monitor)][:limit]
+        return submissions
+
+def print_metadata_stats():
+    stats = get_metadata_stats()
+    print('[ OK ] Media lookup cache:', stats['hits'], 'hits,', stats['misses'], 'misses (' + str(int(stats['hit_rate'] * 100)) + '% hit rate)')
+    if stats['imgur_credits'] is not None:
+        print('[ OK ] Imgur API credits remaining:', stats['imgur_credits'])
+
+# Runs one cycle for every bot: discovers new posts and adds them to the work queue if fetch is True, then works through the queue
+# Every bot posts in its own task, and returns as soon as its next post has to wait, so no bot holds up the others
+
+async def run_cycle(bots, fetcher, media_pool, transcode_pool, fetch=True):
+    loop = asyncio.get_event_loop()
+    with metrics.span('cycle'):
+        if fetch:
+            with metrics.span('reddit_fetch'):
+                submissions = await loop.run_in_executor(None, fetcher.get_submissions, bots)
+            for bot in bots:
+                try:
+                    with metrics.span('queue_posts', bot=bot.name):
+                        bot.queue_posts(bot.get_reddit_posts(submissions[bot]))
+                except BaseException as e:
+                    print('[EROR] Error while checking posts for', bot.name + ':', str(e))
+        await asyncio.gather(*[bot.run(media_pool, transcode_pool) for bot in bots])
+    if fetch:
+        print_metadata_stats()
+
+# Function for getting the time the main loop should run again: when Reddit is next checked, or when a waiting bot can make its next post
+
+def get_wake_time(bots, next_fetch_time):
+    return min([next_fetch_time] + [bot.next_post_time() for bot in bots if bot.waiting])
+
+# Function for sleeping until wake_time, used by the main loop instead of time.sleep() so media keeps being prepared in the background
+# The loop wakes up early when the media for a post that could already be made is ready, so the post isn't held until the next check
+
+async def sleep_until(bots, wake_time):
+    delay = max(0, wake_time - time.time())
+    pending_media = [bot.pending_media for bot in bots if bot.pending_media]
+    if pending_media:
+        await asyncio.wait(pending_media, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+    else:
+        await asyncio.sleep(delay)
@@ -0,0 +1 @@
+# Lets the tests import Tootbot's modules from the repository root
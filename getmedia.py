@@ -1,318 +1,857 @@
 import os
-import sys
-import configparser
 from gfycat.client import GfycatClient
 from imgurpython import ImgurClient
-from PIL import Image
+from imgurpython.helpers.error import ImgurClientError
 import urllib.request
-from urllib.request import urlopen
 import requests
+import requests.adapters
 import re
 import hashlib
+import itertools
+import threading
+import types
+import uuid
+import xml.etree.ElementTree
+import metrics
+from mediacache import MediaCache
+from mediacache import MetadataCache
+from transcode import setup_ffmpeg
+from transcode import has_ffmpeg
+from transcode import convert_video
+from transcode import shrink_image
+from transcode import mux_video
+from transcode import TranscodeError
+from transcode import TWITTER_VIDEO_MAX_SIZE
+from transcode import TWITTER_VIDEO_MAX_DURATION
 
-# Function for opening file as string of bytes
+# File extensions that can be uploaded to Twitter as they are
+TWITTER_FORMATS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
 
-def file_as_bytes(file):
-    with file:
-        return file.read()
+# MIME types that can be posted from links to unknown sites
+IMAGE_FORMATS = ('image/png', 'image/jpeg', 'image/gif', 'image/webp')
+HD_MEDIA_FORMATS = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/mp4')
+
+# Error for media downloads that failed for a reason that might go away, like a timeout or server error
+# Downloads that can never work, like missing files or unsupported links, return None instead
+
+class MediaDownloadError(Exception):
+    pass
+
+# Error for media that a host API says is gone, like a removed Imgur image, so the download is not tried again
+
+class MediaNotFoundError(Exception):
+    pass
+
+# Status codes from media host APIs that mean the media doesn't exist
+MISSING_STATUS_CODES = (400, 404, 410)
+
+# Upload limits for each platform, downloads larger than this are stopped early
+# Tweepy has a 3MB upload limit for media attachments
+TWITTER_MAX_SIZE = 3 * 1024 * 1024
+# Mastodon instances allow 8MB images and 40MB videos by default
+MASTODON_MAX_SIZE = 40 * 1024 * 1024
+MASTODON_IMAGE_MAX_SIZE = 8 * 1024 * 1024
+
+# Number of images Twitter and Mastodon allow in one post
+MAX_ATTACHMENTS = 4
+
+# Still images that are too large for a platform are shrunk with Pillow after downloading, so they aren't stopped at the Twitter limit
+# GIFs can't be shrunk that way, so they still are
+SHRINKABLE_FORMATS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def get_twitter_download_limit(file_extension):
+    if file_extension in SHRINKABLE_FORMATS:
+        return MASTODON_MAX_SIZE
+    return TWITTER_MAX_SIZE
+
+# Settings for media downloads, these can be changed with setup_downloads()
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# Cache for downloaded media, enabled with setup_media_cache()
+media_cache = None
+
+# MD5 hashes of placeholder images that media hosts send instead of the real file, these are never posted
+# The default is Giphy's "This content is not available" GIF, more info: https://github.com/corbindavenport/tootbot/issues/8
+# The list can be changed with setup_placeholders()
+PLACEHOLDER_HASHES = frozenset(('59a41d58693283c72d9da8ae0561e4e5',))
+
+def setup_placeholders(hashes):
+    global PLACEHOLDER_HASHES
+    PLACEHOLDER_HASHES = frozenset(h.strip().lower() for h in hashes if h.strip())
+
+# Shared HTTP session, so connections to each host are kept open and reused between downloads
+session = requests.Session()
+
+# Function for changing the settings for media downloads
+
+def setup_downloads(chunk_size, timeout, workers):
+    global DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+    DOWNLOAD_CHUNK_SIZE = chunk_size
+    # Connecting should never take longer than reading
+    DOWNLOAD_TIMEOUT = (min(10, timeout), timeout)
+    # Keep one connection open per download worker for each host
+    adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+# File extensions for each supported MIME type
+MIME_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'video/mp4': '.mp4'
+}
+
+# Major brands of ISO media files (bytes 8 to 12, after 'ftyp'), which is also the container of HEIF images and QuickTime videos
+FTYP_BRANDS = {
+    b'isom': 'video/mp4',
+    b'iso2': 'video/mp4',
+    b'iso4': 'video/mp4',
+    b'iso5': 'video/mp4',
+    b'iso6': 'video/mp4',
+    b'mp41': 'video/mp4',
+    b'mp42': 'video/mp4',
+    b'avc1': 'video/mp4',
+    b'dash': 'video/mp4',
+    b'mmp4': 'video/mp4',
+    b'M4V ': 'video/mp4',
+    b'M4VH': 'video/mp4',
+    b'qt  ': 'video/quicktime',
+    b'heic': 'image/heic',
+    b'heix': 'image/heic',
+    b'mif1': 'image/heif',
+    b'msf1': 'image/heif',
+    b'avif': 'image/avif',
+    b'avis': 'image/avif'
+}
+
+# Function for identifying a media file from its first few bytes, for servers that don't send a useful Content-Type
+
+def get_mime_type(data):
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    elif data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    elif data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    elif data[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(data[8:12])
+    return
+
+# Function for getting the MIME type of a downloaded or converted file from its extension, which save_file() always sets
+
+def get_file_mime_type(file_path):
+    extension = os.path.splitext(file_path)[-1].lower()
+    if extension == '.jpeg':
+        return 'image/jpeg'
+    return dict((v, k) for k, v in MIME_EXTENSIONS.items()).get(extension)
+
+# Function for enabling the media cache, max_size is in bytes
+
+def setup_media_cache(folder, max_size):
+    global media_cache
+    if max_size > 0:
+        media_cache = MediaCache(folder, max_size)
+        print('[ OK ] Media cache enabled in', folder)
 
 # Function for downloading images from a URL to media folder
+# If allowed_types is set, the file type is checked on the same request before anything is saved
 
-def save_file(img_url, file_path):
-    resp = requests.get(img_url, stream=True)
-    if resp.status_code == 200:
-        with open(file_path, 'wb') as image_file:
-            for chunk in resp:
-                image_file.write(chunk)
-        # Return the path of the image, which is always the same since we just overwrite images
-        image_file.close()
-        return file_path
+def save_file(img_url, file_path, max_size=None, allowed_types=None):
+    # Use the copy in the media cache if this file was downloaded before
+    if media_cache:
+        cached_file = media_cache.get(img_url)
+        metrics.count('cache_lookups', cache='media', result='hit' if cached_file else 'miss')
+        if cached_file:
+            mime = get_file_mime_type(cached_file)
+            if (allowed_types and mime not in allowed_types) or (max_size and os.path.getsize(cached_file) > max_size):
+                # The cached file can't be used for this platform
+                media_cache.release(cached_file)
+                print('[EROR] URL does not point to a valid image file')
+                return
+            print('[ OK ] Using cached file at', cached_file, 'for URL', img_url)
+            return cached_file
+    # Network errors are raised to the caller, so the download can be tried again later
+    with metrics.span('download'):
+        try:
+            resp = session.get(img_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
+            print('[EROR] URL is not valid:', str(e))
+            return
+        with resp:
+            if resp.status_code == 429 or resp.status_code >= 500:
+                # The server is busy or having problems, so this might work later
+                raise MediaDownloadError('File failed to download. Status code: ' + str(resp.status_code))
+            elif resp.status_code != 200:
+                print('[EROR] File failed to download. Status code: ' +
+                      str(resp.status_code))
+                return
+            # Skip files that are too large to upload, before downloading them
+            file_size = resp.headers.get('Content-Length')
+            if max_size and file_size and file_size.isdigit() and int(file_size) > max_size:
+                print('[WARN] File is too large to upload (' + file_size + ' bytes), skipping download')
+                return
+            chunks = resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            first_chunk = next(chunks, b'')
+            # Go by the start of the file, so a server sending something else under the right Content-Type is caught
+            # The MIME type from the headers is only used if the file type isn't recognised
+            mime = get_mime_type(first_chunk)
+            if mime is None:
+                mime = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if allowed_types and mime not in allowed_types:
+                print('[EROR] URL does not point to a valid image file')
+                return
+            # Links like https://example.com/ have no file name, so a fixed one is used
+            if not os.path.basename(file_path):
+                file_path = os.path.join(file_path, 'media')
+            # Add a file extension if the URL didn't have a usable one
+            if mime in MIME_EXTENSIONS and os.path.splitext(file_path)[-1].lower() not in MIME_EXTENSIONS.values() and not file_path.lower().endswith('.jpeg'):
+                file_path += MIME_EXTENSIONS[mime]
+            # Files for the media cache are downloaded under a temporary name, in case another worker is downloading the same URL
+            if media_cache:
+                download_path = file_path + '.' + str(threading.get_ident()) + '.part'
+            else:
+                # Without the cache, every download gets its own name, so bots posting the same link don't write or delete each other's file
+                file_path = get_unique_path(file_path)
+                download_path = file_path
+            file_size = 0
+            # Both hashes are worked out as the file is downloaded, so the file never has to be read again
+            # SHA-256 is used by the media cache, and MD5 for checking against known placeholder images
+            file_hash = hashlib.sha256()
+            placeholder_hash = hashlib.md5()
+            with open(download_path, 'wb') as image_file:
+                for chunk in itertools.chain((first_chunk,), chunks):
+                    file_size += len(chunk)
+                    # The server may not send a Content-Length, so check the size as the file is downloaded too
+                    if max_size and file_size > max_size:
+                        break
+                    file_hash.update(chunk)
+                    placeholder_hash.update(chunk)
+                    image_file.write(chunk)
+        metrics.count('download_bytes', file_size)
+    if max_size and file_size > max_size:
+        print('[WARN] File is too large to upload (over ' + str(max_size) + ' bytes), download stopped')
+        try:
+            os.remove(download_path)
+        except BaseException as e:
+            print('[EROR] Error while deleting media file:', str(e))
+        return
+    if placeholder_hash.hexdigest() in PLACEHOLDER_HASHES:
+        print('[WARN] URL points to a placeholder image instead of the real file, so it can not be posted')
+        try:
+            os.remove(download_path)
+        except BaseException as e:
+            print('[EROR] Error while deleting media file:', str(e))
+        return
+    # Move the file into the media cache, so it doesn't have to be downloaded again
+    if media_cache:
+        return media_cache.add(img_url, download_path, file_hash.hexdigest(), os.path.splitext(file_path)[-1].lower())
+    # Return the path of the image, which is always the same since we just overwrite images
+    return file_path
+
+# Function for adding a random suffix to a file name, before the extension
+
+def get_unique_path(file_path):
+    base, file_extension = os.path.splitext(file_path)
+    return base + '-' + uuid.uuid4().hex[:8] + file_extension
+
+# Function for cleaning up a media file after it has been posted
+# Files in the media cache are kept until the cache runs out of space
+
+def delete_media_file(file_path):
+    if media_cache and media_cache.contains(file_path):
+        media_cache.release(file_path)
     else:
-        print('[EROR] File failed to download. Status code: ' +
-              str(resp.status_code))
+        os.remove(file_path)
+        print('[ OK ] Deleted media file at', file_path)
+
+# Function for deleting a media file that can't be posted, including from the media cache
+
+def discard_media_file(file_path):
+    if media_cache and media_cache.contains(file_path):
+        media_cache.discard(file_path)
+    else:
+        os.remove(file_path)
+
+# Function for picking up a media file downloaded before a restart, returns False if the file is gone
+# Files in the media cache are marked as in use again, so they aren't evicted before the post is made
+
+def keep_media_file(file_path):
+    if not os.path.exists(file_path):
+        return False
+    if media_cache and media_cache.contains(file_path):
+        with media_cache.lock:
+            media_cache.use(file_path)
+    return True
+
+# API clients for media hosts, created once and shared by every lookup
+imgur_client = None
+gfycat_client = None
+client_lock = threading.Lock()
+
+# Cache for media host API lookups, can be replaced with setup_metadata_cache()
+metadata_cache = MetadataCache(86400)
+
+# Function for changing how long media host API lookups are cached, and where they are saved
+
+def setup_metadata_cache(ttl, path=None):
+    global metadata_cache
+    metadata_cache = MetadataCache(ttl, path)
+
+# Functions for getting the shared API clients
+
+def get_imgur_client(IMGUR_CLIENT, IMGUR_CLIENT_SECRET):
+    global imgur_client
+    with client_lock:
+        if imgur_client is None:
+            imgur_client = ImgurClient(IMGUR_CLIENT, IMGUR_CLIENT_SECRET)
+        return imgur_client
+
+def get_gfycat_client():
+    global gfycat_client
+    with client_lock:
+        if gfycat_client is None:
+            gfycat_client = GfycatClient()
+        return gfycat_client
+
+# Functions for looking up media host information, using the cache when possible
+
+def get_imgur_image(client, id):
+    key = 'imgur:image:' + id
+    info = metadata_cache.get(key)
+    if info is None:
+        with metrics.span('api_lookup', host='imgur'):
+            image = client.get_image(id)
+        info = {'type': image.type, 'link': image.link, 'mp4': getattr(image, 'mp4', None)}
+        metadata_cache.set(key, info)
+    return info
+
+def get_imgur_album(client, id):
+    key = 'imgur:album:' + id
+    info = metadata_cache.get(key)
+    if info is None:
+        with metrics.span('api_lookup', host='imgur'):
+            images = client.get_album_images(id)
+        info = [{'type': image.type, 'link': image.link, 'mp4': getattr(image, 'mp4', None)} for image in images]
+        metadata_cache.set(key, info)
+    return info
+
+def get_gfycat_info(name):
+    key = 'gfycat:' + name
+    info = metadata_cache.get(key)
+    if info is None:
+        with metrics.span('api_lookup', host='gfycat'):
+            info = get_gfycat_client().query_gfy(name)
+        metadata_cache.set(key, info)
+    return info
+
+# Function for getting the hit rate of the media host lookup cache, and how many Imgur API credits are left
+
+def get_metadata_stats():
+    stats = metadata_cache.stats()
+    stats['imgur_credits'] = None
+    if imgur_client is not None and imgur_client.credits:
+        stats['imgur_credits'] = imgur_client.credits.get('ClientRemaining')
+    return stats
+
+# Function for setting up media downloads and caches from the bot settings, this only needs to run once at startup
+
+def setup_media(settings):
+    # Make sure media folder exists
+    if not os.path.exists(settings.media_folder):
+        os.makedirs(settings.media_folder, exist_ok=True)
+        print('[ OK ] Media folder not found, created a new one')
+    setup_downloads(settings.download_chunk_size, settings.download_timeout, settings.media_workers)
+    # Lookups from the Imgur and Gfycat APIs are cached, to save API credits
+    try:
+        setup_metadata_cache(settings.metadata_cache_time, settings.metadata_cache_file)
+    except BaseException as e:
+        print('[EROR] Error while opening media lookup cache:', str(e))
+    # Downloaded media is kept in a cache, so the same file is never downloaded twice
+    try:
+        setup_media_cache(os.path.join(settings.media_folder, 'cache'), settings.media_cache_size * 1024 * 1024)
+    except BaseException as e:
+        print('[EROR] Error while opening media cache:', str(e))
+    # Videos are converted for Twitter with ffmpeg, if it is installed
+    setup_ffmpeg(settings.ffmpeg_path)
+    setup_placeholders(settings.placeholder_hashes)
+
+# Media host resolvers
+# Each resolver handles the links for one media host, and can download one or both variants of the media:
+# 'twitter' is a version that fits the Twitter limits as it is, such as a small GIF instead of a video
+# 'hd' is the best version available, used for Mastodon and for converting videos for Twitter
+# Hosts with only one variant download the same file for both platforms, see get_media_files()
+# Resolvers are found by the domain of the link, so adding a new host doesn't make every lookup slower
+# This class handles links to any other site, the file is downloaded if it is an image (or an MP4 file for the 'hd' variant)
+# The type is checked from the MIME type or the start of the file
+
+class Resolver:
+    name = 'Media'
+    # Domains handled by this resolver, subdomains are matched too
+    domains = ()
+    # Variants this resolver can download
+    variants = ('twitter', 'hd')
+
+    def resolve(self, url, variant, submission, settings):
+        file_name = os.path.basename(urllib.parse.urlsplit(url).path)
+        file_path = settings.media_folder + '/' + file_name
+        print('[ OK ] Downloading file at URL ' +
+              url + ' to ' + file_path)
+        if variant == 'hd':
+            return save_file(url, file_path, MASTODON_MAX_SIZE, HD_MEDIA_FORMATS)
+        # Still images are shrunk for Twitter after downloading, and links without a usable extension might be one
+        # Large GIFs are converted to MP4 or dropped by get_twitter_media()
+        file_extension = os.path.splitext(file_name)[-1].lower()
+        max_size = TWITTER_MAX_SIZE if file_extension == '.gif' else MASTODON_MAX_SIZE
+        return save_file(url, file_path, max_size, IMAGE_FORMATS)
+
+class RedditImageResolver(Resolver):
+    name = 'Reddit image'
+    domains = ('i.redd.it', 'i.reddituploads.com')
+    # Reddit only has the original file, large images and GIFs are shrunk or converted for Twitter afterwards
+    variants = ('hd',)
+
+    def resolve(self, url, variant, submission, settings):
+        file_name = os.path.basename(urllib.parse.urlsplit(url).path)
+        file_extension = os.path.splitext(url)[-1].lower()
+        # Fix for issue with i.reddituploads.com links not having a file extension in the URL
+        if not file_extension:
+            file_extension += '.jpg'
+            file_name += '.jpg'
+            url += '.jpg'
+        # Download the file
+        file_path = settings.media_folder + '/' + file_name
+        print('[ OK ] Downloading file at URL ' + url + ' to ' +
+              file_path + ', file type identified as ' + file_extension)
+        return save_file(url, file_path, MASTODON_MAX_SIZE)
+
+# Function for reading the video and audio renditions of a Reddit video from its DASH manifest
+# Returns a dict with lists of [bandwidth, URL] for 'video' and 'audio', largest first
+
+def get_reddit_dash(dash_url):
+    key = 'reddit:dash:' + dash_url
+    info = metadata_cache.get(key)
+    if info is None:
+        try:
+            with metrics.span('api_lookup', host='reddit'):
+                resp = session.get(dash_url, timeout=DOWNLOAD_TIMEOUT)
+            resp.raise_for_status()
+            root = xml.etree.ElementTree.fromstring(resp.content)
+        except (requests.RequestException, xml.etree.ElementTree.ParseError) as e:
+            raise MediaDownloadError('Could not read DASH manifest: ' + str(e))
+        base_url = dash_url.rsplit('/', 1)[0] + '/'
+        info = {'video': [], 'audio': []}
+        # Tags are namespaced, and older manifests set the type on each rendition instead of the adaptation set
+        for adaptation_set in root.iter():
+            if not adaptation_set.tag.endswith('AdaptationSet'):
+                continue
+            for representation in adaptation_set:
+                if not representation.tag.endswith('Representation'):
+                    continue
+                content_type = adaptation_set.get('contentType') or adaptation_set.get('mimeType') or representation.get('mimeType') or ''
+                media_type = content_type.split('/')[0]
+                base = [child.text for child in representation if child.tag.endswith('BaseURL')]
+                if media_type in info and base and base[0]:
+                    info[media_type].append([int(representation.get('bandwidth', 0)), urllib.parse.urljoin(base_url, base[0].strip())])
+        for renditions in info.values():
+            renditions.sort(reverse=True)
+        metadata_cache.set(key, info)
+    return info
+
+# Reddit videos are picked from the DASH manifest, so each platform gets the largest rendition that fits its limit
+# The video and audio tracks are separate, and are combined without re-encoding when ffmpeg is installed
+
+class RedditVideoResolver(Resolver):
+    name = 'Reddit video'
+    domains = ('v.redd.it',)
+    # Size limit for each variant, Twitter takes larger videos through chunked uploads
+    max_sizes = {'twitter': TWITTER_VIDEO_MAX_SIZE, 'hd': MASTODON_MAX_SIZE}
+
+    def resolve(self, url, variant, submission, settings):
+        if not submission or not submission.media:
+            print('[EROR] Reddit API returned no media for this URL:', url)
+            return
+        reddit_video = submission.media['reddit_video']
+        duration = reddit_video.get('duration') or 0
+        max_size = self.max_sizes[variant]
+        if variant == 'twitter' and duration > TWITTER_VIDEO_MAX_DURATION:
+            print('[WARN] Reddit video is too long for Twitter without converting it')
+            return
+        if reddit_video.get('dash_url') and duration:
+            try:
+                return self.resolve_dash(reddit_video['dash_url'], duration, max_size, variant, submission, settings)
+            except MediaDownloadError as e:
+                print('[WARN] Error while reading Reddit video manifest, using the fallback URL:', str(e))
+        # Get URL for MP4 version of reddit video, which has no sound
+        video_url = reddit_video['fallback_url']
+        # Download the file
+        file_path = settings.media_folder + '/' + submission.id + '.mp4'
+        print('[ OK ] Downloading Reddit video at URL ' +
+              video_url + ' to ' + file_path)
+        return save_file(video_url, file_path, max_size, ('video/mp4',))
+
+    def resolve_dash(self, dash_url, duration, max_size, variant, submission, settings):
+        dash = get_reddit_dash(dash_url)
+        audio_url = dash['audio'][0][1] if dash['audio'] and has_ffmpeg() else None
+        audio_bandwidth = dash['audio'][0][0] if audio_url else 0
+        # Sizes are worked out from the bandwidth, with 5% left for the MP4 container
+        renditions = [(bandwidth, video_url) for bandwidth, video_url in dash['video'] if (bandwidth + audio_bandwidth) * duration / 8 * 1.05 <= max_size]
+        if not renditions:
+            print('[WARN] Every version of this Reddit video is too large for ' + VARIANT_PLATFORMS[variant])
+            return
+        audio_file = None
+        try:
+            for bandwidth, video_url in renditions:
+                file_path = settings.media_folder + '/' + submission.id + '-' + os.path.splitext(os.path.basename(video_url))[0] + '.mp4'
+                print('[ OK ] Downloading Reddit video at URL ' +
+                      video_url + ' to ' + file_path)
+                video_file = save_file(video_url, file_path, max_size, ('video/mp4',))
+                if not video_file:
+                    continue
+                if not audio_url:
+                    return video_file
+                if not audio_file:
+                    audio_path = settings.media_folder + '/' + submission.id + '-audio.mp4'
+                    print('[ OK ] Downloading Reddit audio at URL ' +
+                          audio_url + ' to ' + audio_path)
+                    audio_file = save_file(audio_url, audio_path, max_size, ('video/mp4',))
+                    if not audio_file:
+                        # The video is posted without sound rather than not at all
+                        return video_file
+                try:
+                    with metrics.span('transcode', kind='mux'):
+                        muxed_file = mux_video(video_file, audio_file, get_converted_path(submission, variant, settings) + '.mp4')
+                except TranscodeError as e:
+                    print('[WARN] Error while adding audio to Reddit video:', str(e))
+                    return video_file
+                delete_media_file(video_file)
+                if os.path.getsize(muxed_file) <= max_size:
+                    return muxed_file
+                # The estimate was too low, try the next smaller version
+                os.remove(muxed_file)
+            print('[WARN] Every version of this Reddit video is too large for ' + VARIANT_PLATFORMS[variant])
+            return
+        finally:
+            if audio_file:
+                delete_media_file(audio_file)
+
+class ImgurResolver(Resolver):
+    name = 'Imgur'
+    domains = ('imgur.com',)
+    # Working demo of regex: https://regex101.com/r/G29uGl/2
+    ID_PATTERN = re.compile(r"(?:.*)imgur\.com(?:\/gallery\/|\/a\/|\/)(.*?)(?:\/.*|\.|$)")
+
+    def resolve(self, url, variant, submission, settings):
+        try:
+            client = get_imgur_client(settings.imgur_client, settings.imgur_client_secret)
+        except BaseException as e:
+            print('[EROR] Error while authenticating with Imgur:', str(e))
+            return
+        m = self.ID_PATTERN.search(url)
+        if not m:
+            print(
+                '[EROR] Could not identify Imgur image/gallery ID in this URL:', url)
+            return
+        # Get the Imgur image/gallery ID
+        id = m.group(1)
+        try:
+            if any(s in url for s in ('/a/', '/gallery/')):  # Gallery links
+                images = get_imgur_album(client, id)
+                if not images:
+                    print('[EROR] Imgur album is empty:', url)
+                    return
+                # Only the first image in a gallery is used
+                image = images[0]
+            else:  # Single image/GIF
+                image = get_imgur_image(client, id)
+        except ImgurClientError as e:
+            if e.status_code in MISSING_STATUS_CODES:
+                raise MediaNotFoundError('Imgur image not found: ' + str(e))
+            raise
+        if variant == 'hd':
+            if image['type'] == 'image/gif' and image['mp4']:
+                # If the image is a GIF, use the MP4 version
+                imgur_url = image['mp4']
+            else:
+                imgur_url = image['link']
+        else:
+            imgur_url = image['link']
+            # If the URL is a GIFV or MP4 link, change it to the GIF version
+            for video_extension in ('.gifv', '.mp4'):
+                if imgur_url.lower().endswith(video_extension):
+                    imgur_url = imgur_url[:-len(video_extension)] + '.gif'
+        file_extension = os.path.splitext(imgur_url)[-1].lower()
+        # Download the image
+        file_path = settings.media_folder + '/' + id + file_extension
+        print('[ OK ] Downloading Imgur image at URL ' +
+              imgur_url + ' to ' + file_path)
+        if variant == 'hd':
+            return save_file(imgur_url, file_path, MASTODON_MAX_SIZE)
+        # Imgur will sometimes return a single-frame thumbnail instead of a GIF, so the start of the file is checked while downloading
+        if (file_extension == '.gif'):
+            imgur_file = save_file(imgur_url, file_path, get_twitter_download_limit(file_extension), ('image/gif',))
+            if not imgur_file:
+                print('[WARN] Imgur has not processed a GIF version of this link, so it can not be posted to Twitter')
+            return imgur_file
+        return save_file(imgur_url, file_path, get_twitter_download_limit(file_extension))
+
+class GfycatResolver(Resolver):
+    name = 'Gfycat'
+    domains = ('gfycat.com',)
+
+    def resolve(self, url, variant, submission, settings):
+        try:
+            gfycat_name = os.path.basename(urllib.parse.urlsplit(url).path)
+            gfycat_info = get_gfycat_info(gfycat_name)
+        except BaseException as e:
+            print('[EROR] Error downloading Gfycat link:', str(e))
+            if getattr(e, 'status_code', None) in MISSING_STATUS_CODES:
+                raise MediaNotFoundError('Gfycat link not found: ' + str(e))
+            raise MediaDownloadError('Gfycat lookup failed: ' + str(e))
+        if variant == 'hd':
+            # Download the MP4 version
+            gfycat_url = gfycat_info['gfyItem']['mp4Url']
+            file_path = settings.media_folder + '/' + gfycat_name + '.mp4'
+            max_size = MASTODON_MAX_SIZE
+        else:
+            # Download the 2MB version because Tweepy has a 3MB upload limit for GIFs
+            gfycat_url = gfycat_info['gfyItem']['max2mbGif']
+            file_path = settings.media_folder + '/' + gfycat_name + '.gif'
+            max_size = TWITTER_MAX_SIZE
+        print('[ OK ] Downloading Gfycat at URL ' +
+              gfycat_url + ' to ' + file_path)
+        return save_file(gfycat_url, file_path, max_size)
+
+class GiphyResolver(Resolver):
+    name = 'Giphy'
+    domains = ('giphy.com',)
+    # Working demo of regex: https://regex101.com/r/o8m1kA/2
+    ID_PATTERN = re.compile(r"https?://((?:.*)giphy\.com/media/|giphy.com/gifs/|i.giphy.com/)(.*-)?(\w+)(/|\n)")
+
+    def resolve(self, url, variant, submission, settings):
+        m = self.ID_PATTERN.search(url)
+        if not m:
+            print('[EROR] Could not identify Giphy ID in this URL:', url)
+            return
+        # Get the Giphy ID
+        id = m.group(3)
+        if variant == 'hd':
+            # Download the MP4 version of the GIF
+            giphy_url = 'https://media.giphy.com/media/' + id + '/giphy.mp4'
+            file_path = settings.media_folder + '/' + id + 'giphy.mp4'
+            max_size = MASTODON_MAX_SIZE
+        else:
+            # Download the 2MB version because Tweepy has a 3MB upload limit for GIFs
+            # Giphy sends a GIF saying "This content is not available" if the 2MB version doesn't exist, save_file() skips it
+            giphy_url = 'https://media.giphy.com/media/' + id + '/giphy-downsized.gif'
+            file_path = settings.media_folder + '/' + id + '-downsized.gif'
+            max_size = TWITTER_MAX_SIZE
+        print('[ OK ] Downloading Giphy at URL ' +
+              giphy_url + ' to ' + file_path)
+        return save_file(giphy_url, file_path, max_size)
+
+# Platform that each variant is downloaded for, used in warnings
+VARIANT_PLATFORMS = {'twitter': 'Twitter', 'hd': 'Mastodon'}
+
+# Registry of resolvers by domain
+RESOLVERS = {}
+generic_resolver = Resolver()
+
+def register_resolver(resolver):
+    for domain in resolver.domains:
+        RESOLVERS[domain] = resolver
+    return resolver
+
+reddit_video_resolver = register_resolver(RedditVideoResolver())
+imgur_resolver = register_resolver(ImgurResolver())
+for resolver_class in (RedditImageResolver, GfycatResolver, GiphyResolver):
+    register_resolver(resolver_class())
+
+# Function for finding the resolver for a link
+# The host is normalised once, then looked up along with each parent domain, so i.imgur.com is handled by the imgur.com resolver
+
+def find_resolver(url):
+    host = urllib.parse.urlsplit(url.strip()).hostname or ''
+    if host.startswith('www.'):
+        host = host[4:]
+    while host:
+        resolver = RESOLVERS.get(host)
+        if resolver:
+            return resolver
+        host = host.partition('.')[2]
+    return generic_resolver
+
+# Function for downloading one variant of the media in a link, returns None if it can't be downloaded
+
+def resolve_media(url, variant, submission, settings):
+    resolver = find_resolver(url)
+    if variant not in resolver.variants:
         return
+    with metrics.span('resolve', host=resolver.name, variant=variant):
+        return resolver.resolve(url, variant, submission, settings)
 
 # Function for obtaining static images and GIFs from popular image hosts
 
-def get_media(img_url, IMGUR_CLIENT, IMGUR_CLIENT_SECRET):
-  # Make sure config file exists
-  try:
-      config = configparser.ConfigParser()
-      config.read('config.ini')
-  except BaseException as e:
-      print('[EROR] Error while reading config file:', str(e))
-      sys.exit()
-  # Make sure media folder exists
-  IMAGE_DIR = config['MediaSettings']['MediaFolder']
-  if not os.path.exists(IMAGE_DIR):
-      os.makedirs(IMAGE_DIR)
-      print('[ OK ] Media folder not found, created a new one')
-  # Download and save the linked image
-  if any(s in img_url for s in ('i.redd.it', 'i.reddituploads.com')):  # Reddit-hosted images
-      file_name = os.path.basename(urllib.parse.urlsplit(img_url).path)
-      file_extension = os.path.splitext(img_url)[-1].lower()
-      # Fix for issue with i.reddituploads.com links not having a file extension in the URL
-      if not file_extension:
-          file_extension += '.jpg'
-          file_name += '.jpg'
-          img_url += '.jpg'
-      # Download the file
-      file_path = IMAGE_DIR + '/' + file_name
-      print('[ OK ] Downloading file at URL ' + img_url + ' to ' +
-            file_path + ', file type identified as ' + file_extension)
-      img = save_file(img_url, file_path)
-      return img
-  elif ('v.redd.it' in img_url):  # Reddit video
-      print ('[WARN] Reddit videos can not be uploaded to Twitter, due to API limitations')
-      return
-  elif ('imgur.com' in img_url):  # Imgur
-      try:
-          client = ImgurClient(IMGUR_CLIENT, IMGUR_CLIENT_SECRET)
-      except BaseException as e:
-          print('[EROR] Error while authenticating with Imgur:', str(e))
-          return
-      # Working demo of regex: https://regex101.com/r/G29uGl/2
-      regex = r"(?:.*)imgur\.com(?:\/gallery\/|\/a\/|\/)(.*?)(?:\/.*|\.|$)"
-      m = re.search(regex, img_url, flags=0)
-      if m:
-          # Get the Imgur image/gallery ID
-          id = m.group(1)
-          if any(s in img_url for s in ('/a/', '/gallery/')):  # Gallery links
-              images = client.get_album_images(id)
-              # Only the first image in a gallery is used
-              imgur_url = images[0].link
-          else:  # Single image
-              imgur_url = client.get_image(id).link
-          # If the URL is a GIFV or MP4 link, change it to the GIF version
-          file_extension = os.path.splitext(imgur_url)[-1].lower()
-          if (file_extension == '.gifv'):
-              file_extension = file_extension.replace('.gifv', '.gif')
-              imgur_url = imgur_url.replace('.gifv', '.gif')
-          elif (file_extension == '.mp4'):
-              file_extension = file_extension.replace('.mp4', '.gif')
-              imgur_url = imgur_url.replace('.mp4', '.gif')
-          # Download the image
-          file_path = IMAGE_DIR + '/' + id + file_extension
-          print('[ OK ] Downloading Imgur image at URL ' +
-                imgur_url + ' to ' + file_path)
-          imgur_file = save_file(imgur_url, file_path)
-          # Imgur will sometimes return a single-frame thumbnail instead of a GIF, so we need to check for this
-          if (file_extension == '.gif'):
-              # Open the file using the Pillow library
-              img = Image.open(imgur_file)
-              # Get the MIME type
-              mime = Image.MIME[img.format]
-              if (mime == 'image/gif'):
-                  # Image is indeed a GIF, so it can be posted
-                  img.close()
-                  return imgur_file
-              else:
-                  # Image is not actually a GIF, so don't post it
-                  print('[WARN] Imgur has not processed a GIF version of this link, so it can not be posted to Twitter')
-                  img.close()
-                  # Delete the image
-                  try:
-                      os.remove(imgur_file)
-                  except BaseException as e:
-                      print('[EROR] Error while deleting media file:', str(e))
-                  return
-          else:
-              return imgur_file
-      else:
-          print(
-              '[EROR] Could not identify Imgur image/gallery ID in this URL:', img_url)
-          return
-  elif ('gfycat.com' in img_url):  # Gfycat
-      try:
-        gfycat_name = os.path.basename(urllib.parse.urlsplit(img_url).path)
-        client = GfycatClient()
-        gfycat_info = client.query_gfy(gfycat_name)
-      except BaseException as e:
-        print('[EROR] Error downloading Gfycat link:', str(e))
-        return
-      # Download the 2MB version because Tweepy has a 3MB upload limit for GIFs
-      gfycat_url = gfycat_info['gfyItem']['max2mbGif']
-      file_path = IMAGE_DIR + '/' + gfycat_name + '.gif'
-      print('[ OK ] Downloading Gfycat at URL ' +
-            gfycat_url + ' to ' + file_path)
-      gfycat_file = save_file(gfycat_url, file_path)
-      return gfycat_file
-  elif ('giphy.com' in img_url):  # Giphy
-      # Working demo of regex: https://regex101.com/r/o8m1kA/2
-      regex = r"https?://((?:.*)giphy\.com/media/|giphy.com/gifs/|i.giphy.com/)(.*-)?(\w+)(/|\n)"
-      m = re.search(regex, img_url, flags=0)
-      if m:
-          # Get the Giphy ID
-          id = m.group(3)
-          # Download the 2MB version because Tweepy has a 3MB upload limit for GIFs
-          giphy_url = 'https://media.giphy.com/media/' + id + '/giphy-downsized.gif'
-          file_path = IMAGE_DIR + '/' + id + '-downsized.gif'
-          print('[ OK ] Downloading Giphy at URL ' +
-                giphy_url + ' to ' + file_path)
-          giphy_file = save_file(giphy_url, file_path)
-          # Check the hash to make sure it's not a GIF saying "This content is not available"
-          # More info: https://github.com/corbindavenport/tootbot/issues/8
-          hash = hashlib.md5(file_as_bytes(
-              open(giphy_file, 'rb'))).hexdigest()
-          if (hash == '59a41d58693283c72d9da8ae0561e4e5'):
-              print('[WARN] Giphy has not processed a 2MB GIF version of this link, so it can not be posted to Twitter')
-              return
-          else:
-              return giphy_file
-      else:
-          print('[EROR] Could not identify Giphy ID in this URL:', img_url)
-          return
-  else:
-      # Check if URL is an image, based on the MIME type
-      image_formats = ('image/png', 'image/jpeg', 'image/gif', 'image/webp')
-      img_site = urlopen(img_url)
-      meta = img_site.info()
-      if meta["content-type"] in image_formats:
-          # URL appears to be an image, so download it
-          file_name = os.path.basename(urllib.parse.urlsplit(img_url).path)
-          file_path = IMAGE_DIR + '/' + file_name
-          print('[ OK ] Downloading file at URL ' +
-                img_url + ' to ' + file_path)
-          try:
-              img = save_file(img_url, file_path)
-              return img
-          except BaseException as e:
-              print('[EROR] Error while downloading image:', str(e))
-              return
-      else:
-          print('[EROR] URL does not point to a valid image file')
-          return
+def get_media(img_url, settings, submission=None):
+    return resolve_media(img_url, 'twitter', submission, settings)
 
 # Function for obtaining static images/GIFs, or MP4 videos if they exist, from popular image hosts
-# This is currently only used for Mastodon posts, because the Tweepy API doesn't support video uploads
-
-
-def get_hd_media(submission, IMGUR_CLIENT, IMGUR_CLIENT_SECRET):
-  media_url = submission.url
-  # Make sure config file exists
-  try:
-      config = configparser.ConfigParser()
-      config.read('config.ini')
-  except BaseException as e:
-      print('[EROR] Error while reading config file:', str(e))
-      sys.exit()
-  # Make sure media folder exists
-  IMAGE_DIR = config['MediaSettings']['MediaFolder']
-  if not os.path.exists(IMAGE_DIR):
-      os.makedirs(IMAGE_DIR)
-      print('[ OK ] Media folder not found, created a new one')
-  # Download and save the linked image
-  if any(s in media_url for s in ('i.redd.it', 'i.reddituploads.com')):  # Reddit-hosted images
-      file_name = os.path.basename(urllib.parse.urlsplit(media_url).path)
-      file_extension = os.path.splitext(media_url)[-1].lower()
-      # Fix for issue with i.reddituploads.com links not having a file extension in the URL
-      if not file_extension:
-          file_extension += '.jpg'
-          file_name += '.jpg'
-          media_url += '.jpg'
-      # Download the file
-      file_path = IMAGE_DIR + '/' + file_name
-      print('[ OK ] Downloading file at URL ' + media_url + ' to ' +
-            file_path + ', file type identified as ' + file_extension)
-      img = save_file(media_url, file_path)
-      return img
-  elif ('v.redd.it' in media_url):  # Reddit video
-      if submission.media:
-          # Get URL for MP4 version of reddit video
-          video_url = submission.media['reddit_video']['fallback_url']
-          # Download the file
-          file_path = IMAGE_DIR + '/' + submission.id + '.mp4'
-          print('[ OK ] Downloading Reddit video at URL ' +
-                video_url + ' to ' + file_path)
-          video = save_file(video_url, file_path)
-          return video
-      else:
-          print('[EROR] Reddit API returned no media for this URL:', media_url)
-          return
-  elif ('imgur.com' in media_url):  # Imgur
-      try:
-          client = ImgurClient(IMGUR_CLIENT, IMGUR_CLIENT_SECRET)
-      except BaseException as e:
-          print('[EROR] Error while authenticating with Imgur:', str(e))
-          return
-      # Working demo of regex: https://regex101.com/r/G29uGl/2
-      regex = r"(?:.*)imgur\.com(?:\/gallery\/|\/a\/|\/)(.*?)(?:\/.*|\.|$)"
-      m = re.search(regex, media_url, flags=0)
-      if m:
-          # Get the Imgur image/gallery ID
-          id = m.group(1)
-          if any(s in media_url for s in ('/a/', '/gallery/')):  # Gallery links
-              images = client.get_album_images(id)
-              # Only the first image in a gallery is used
-              imgur_url = images[0].link
-              print(images[0])
-          else:  # Single image/GIF
-              if client.get_image(id).type == 'image/gif':
-                  # If the image is a GIF, use the MP4 version
-                  imgur_url = client.get_image(id).mp4
-              else:
-                  imgur_url = client.get_image(id).link
-          file_extension = os.path.splitext(imgur_url)[-1].lower()
-          # Download the image
-          file_path = IMAGE_DIR + '/' + id + file_extension
-          print('[ OK ] Downloading Imgur image at URL ' +
-                imgur_url + ' to ' + file_path)
-          imgur_file = save_file(imgur_url, file_path)
-          return imgur_file
-      else:
-          print(
-              '[EROR] Could not identify Imgur image/gallery ID in this URL:', media_url)
-          return
-  elif ('gfycat.com' in media_url):  # Gfycat
-      try:
-        gfycat_name = os.path.basename(urllib.parse.urlsplit(media_url).path)
-        client = GfycatClient()
-        gfycat_info = client.query_gfy(gfycat_name)
-      except BaseException as e:
-        print('[EROR] Error downloading Gfycat link:', str(e))
+# This is used for Mastodon posts, and for Twitter posts when videos can be converted with ffmpeg
+
+def get_hd_media(submission, settings):
+    return resolve_media(submission.url, 'hd', submission, settings)
+
+# Function for getting the links of each image in a Reddit gallery or Imgur album, up to the attachment limit
+# Returns an empty list for other posts, which are downloaded from the post link as usual
+
+def get_gallery_urls(submission, settings):
+    gallery_data = getattr(submission, 'gallery_data', None)
+    media_metadata = getattr(submission, 'media_metadata', None)
+    if gallery_data and media_metadata:
+        urls = []
+        for item in gallery_data['items']:
+            info = media_metadata.get(item['media_id'])
+            # Images that are still processing or were removed are skipped
+            if not info or info.get('status') != 'valid' or 'm' not in info:
+                continue
+            file_extension = '.' + info['m'].split('/')[-1].replace('jpeg', 'jpg')
+            urls.append('https://i.redd.it/' + item['media_id'] + file_extension)
+        if not urls:
+            print('[WARN] Reddit gallery has no images that can be downloaded')
+        return urls[:MAX_ATTACHMENTS]
+    if find_resolver(submission.url) is imgur_resolver and any(s in submission.url for s in ('/a/', '/gallery/')):
+        m = ImgurResolver.ID_PATTERN.search(submission.url)
+        if not m:
+            return []
+        try:
+            client = get_imgur_client(settings.imgur_client, settings.imgur_client_secret)
+            images = get_imgur_album(client, m.group(1))
+        except BaseException as e:
+            print('[EROR] Error while getting Imgur album:', str(e))
+            return []
+        if len(images) < 2:
+            return []
+        images = images[:MAX_ATTACHMENTS]
+        # The album already has the details of each image, so they are saved to the lookup cache instead of being requested again
+        for image in images:
+            image_id = os.path.splitext(os.path.basename(urllib.parse.urlsplit(image['link']).path))[0]
+            metadata_cache.set('imgur:image:' + image_id, image)
+        return [image['link'] for image in images]
+    return []
+
+# Function for making a stand-in submission for one image in a gallery, so it can be downloaded and converted like a single post
+
+def get_gallery_item(submission, url, index):
+    return types.SimpleNamespace(id=submission.id + '-' + str(index), url=url, media=None)
+
+# Function for choosing the files to attach to a post
+# Twitter and Mastodon take up to four images, or a single video or GIF, so the first file decides which it is
+
+def get_attachments(files):
+    files = [f for f in files if f]
+    if not files:
+        return []
+    if os.path.splitext(files[0])[-1].lower() in ('.mp4', '.gif'):
+        return files[:1]
+    return [f for f in files if os.path.splitext(f)[-1].lower() not in ('.mp4', '.gif')][:MAX_ATTACHMENTS]
+
+# Function for downloading media for a Reddit post, for Twitter and/or Mastodon
+# The best available version is downloaded once, and the Twitter version is only downloaded separately if the file can't be shared
+# Hosts with only one variant (see Resolver.variants) are downloaded once for both platforms
+
+def get_media_files(submission, settings):
+    resolver = find_resolver(submission.url)
+    media_file = None
+    hd_media_file = None
+    # Videos can be converted for Twitter, so the best version is downloaded for Twitter too when ffmpeg is installed
+    use_hd = settings.post_to_mastodon or (settings.post_to_twitter and (has_ffmpeg() or 'twitter' not in resolver.variants))
+    tried_hd = use_hd and 'hd' in resolver.variants
+    if tried_hd:
+        hd_media_file = get_hd_media(submission, settings)
+    if settings.post_to_twitter or not tried_hd:
+        if hd_media_file and os.path.splitext(hd_media_file)[-1].lower() in TWITTER_FORMATS:
+            # Static images and GIFs are the same file on both platforms
+            print('[ OK ] Using the same media file for Twitter:', hd_media_file)
+            media_file = hd_media_file
+        elif hd_media_file and resolver is reddit_video_resolver:
+            # Reddit videos have a version for each size, so Twitter gets one that fits without converting it
+            duration = submission.media['reddit_video'].get('duration') or 0
+            if os.path.getsize(hd_media_file) <= TWITTER_VIDEO_MAX_SIZE and duration <= TWITTER_VIDEO_MAX_DURATION:
+                print('[ OK ] Using the same media file for Twitter:', hd_media_file)
+                media_file = hd_media_file
+            else:
+                media_file = get_media(submission.url, settings, submission)
+        elif hd_media_file and has_ffmpeg():
+            # Videos are converted for Twitter by get_twitter_media() in the transcode stage
+            media_file = None
+        elif hd_media_file or not tried_hd:
+            # Without ffmpeg, videos need a separate GIF version for Twitter
+            # If the best version couldn't be downloaded, the same link isn't downloaded again
+            media_file = get_media(submission.url, settings, submission)
+    if not tried_hd:
+        # Hosts without a separate best version post the Twitter version to Mastodon too
+        hd_media_file = media_file if settings.post_to_mastodon else None
+        if not settings.post_to_twitter:
+            media_file = None
+    return media_file, hd_media_file
+
+# Function for getting a name for a converted media file
+# The source can be shared with the other platform, other bots or the media cache, so converted files get their own name
+
+def get_converted_path(submission, platform, settings):
+    return os.path.join(settings.media_folder, submission.id + '-' + settings.name + '-' + platform)
+
+# Function for shrinking an image that is too large for a platform, returns None if it can't be made small enough
+
+def shrink_media_file(file_path, max_size, submission, platform, settings):
+    print('[ OK ] Shrinking', file_path, 'for', platform.capitalize(), '(' + str(os.path.getsize(file_path) // 1024) + 'KB)')
+    try:
+        with metrics.span('transcode', kind='shrink'):
+            return shrink_image(file_path, get_converted_path(submission, platform, settings), max_size)
+    except BaseException as e:
+        print('[WARN] Error while shrinking image for ' + platform.capitalize() + ':', str(e))
         return
-      # Download the Mp4 version
-      gfycat_url = gfycat_info['gfyItem']['mp4Url']
-      file_path = IMAGE_DIR + '/' + gfycat_name + '.mp4'
-      print('[ OK ] Downloading Gfycat at URL ' +
-            gfycat_url + ' to ' + file_path)
-      gfycat_file = save_file(gfycat_url, file_path)
-      return gfycat_file
-  elif ('giphy.com' in media_url):  # Giphy
-      # Working demo of regex: https://regex101.com/r/o8m1kA/2
-      regex = r"https?://((?:.*)giphy\.com/media/|giphy.com/gifs/|i.giphy.com/)(.*-)?(\w+)(/|\n)"
-      m = re.search(regex, media_url, flags=0)
-      if m:
-          # Get the Giphy ID
-          id = m.group(3)
-          # Download the MP4 version of the GIF
-          giphy_url = 'https://media.giphy.com/media/' + id + '/giphy.mp4'
-          file_path = IMAGE_DIR + '/' + id + 'giphy.mp4'
-          print('[ OK ] Downloading Giphy at URL ' +
-                giphy_url + ' to ' + file_path)
-          giphy_file = save_file(giphy_url, file_path)
-          return giphy_file
-      else:
-          print('[EROR] Could not identify Giphy ID in this URL:', media_url)
-          return
-  else:
-      # Check if URL is an image or MP4 file, based on the MIME type
-      image_formats = ('image/png', 'image/jpeg',
-                        'image/gif', 'image/webp', 'video/mp4')
-      img_site = urlopen(media_url)
-      meta = img_site.info()
-      if meta["content-type"] in image_formats:
-          # URL appears to be an image, so download it
-          file_name = os.path.basename(urllib.parse.urlsplit(media_url).path)
-          file_path = IMAGE_DIR + '/' + file_name
-          print('[ OK ] Downloading file at URL ' +
-                media_url + ' to ' + file_path)
-          try:
-              img = save_file(media_url, file_path)
-              return img
-          except BaseException as e:
-              print('[EROR] Error while downloading image:', str(e))
-              return
-      else:
-          print('[EROR] URL does not point to a valid image file.')
-          return
+
+# Function for converting media for Twitter, run in the transcode stage after get_media_files()
+# Images too large for Twitter are shrunk, and videos and large GIFs are converted to a size-capped H.264 MP4
+# A GIF version is only downloaded if the video can't be converted
+
+def get_twitter_media(media_file, hd_media_file, submission, settings):
+    if media_file and os.path.splitext(media_file)[-1].lower() in SHRINKABLE_FORMATS and os.path.getsize(media_file) > TWITTER_MAX_SIZE:
+        return shrink_media_file(media_file, TWITTER_MAX_SIZE, submission, 'twitter', settings)
+    source = None
+    if not media_file and hd_media_file and os.path.splitext(hd_media_file)[-1].lower() == '.mp4':
+        source = hd_media_file
+    elif media_file and os.path.splitext(media_file)[-1].lower() == '.gif' and os.path.getsize(media_file) > TWITTER_MAX_SIZE:
+        source = media_file
+    if not source:
+        return media_file
+    if has_ffmpeg():
+        file_path = get_converted_path(submission, 'twitter', settings) + '.mp4'
+        try:
+            print('[ OK ] Converting', source, 'to MP4 for Twitter')
+            with metrics.span('transcode', kind='convert'):
+                return convert_video(source, file_path)
+        except BaseException as e:
+            print('[WARN] Error while converting video for Twitter:', str(e))
+    if media_file:
+        # The GIF is too large to upload
+        print('[WARN] GIF is too large for Twitter, posting without it')
+        return
+    if not has_ffmpeg():
+        # get_media_files() already tried the Twitter version, since videos can't be converted without ffmpeg
+        return
+    # Last resort, use the GIF version from the media host
+    return get_media(submission.url, settings, submission)
+
+# Function for preparing media for Mastodon, run in the transcode stage after get_media_files()
+# Images too large for Mastodon are shrunk, other media is posted as downloaded
+
+def get_mastodon_media(hd_media_file, submission, settings):
+    if hd_media_file and os.path.splitext(hd_media_file)[-1].lower() in SHRINKABLE_FORMATS and os.path.getsize(hd_media_file) > MASTODON_IMAGE_MAX_SIZE:
+        return shrink_media_file(hd_media_file, MASTODON_IMAGE_MAX_SIZE, submission, 'mastodon', settings)
+    return hd_media_file
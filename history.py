@@ -0,0 +1,216 @@
+import os
+import csv
+import time
+import sqlite3
+import collections
+import metrics
+
+# Column headers used by the cache spreadsheet, also kept by the SQLite history
+CSV_HEADER = ['Reddit post ID', 'Date and time', 'Post link']
+
+# Function for getting the timestamp format used in the post history
+
+def get_post_date():
+    return time.strftime("%d/%m/%Y") + ' ' + time.strftime("%H:%M:%S")
+
+# Post history stored in the cache spreadsheet
+# The file is only read once at startup, after that the IDs are kept in memory and new rows are appended
+
+class CsvHistory:
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = set()
+        if not os.path.exists(path):
+            with open(path, 'w', newline='') as cache:
+                wr = csv.writer(cache)
+                wr.writerow(CSV_HEADER)
+            print('[ OK ] ' + path + ' file not found, created a new one')
+        else:
+            with open(path, 'rt', newline='') as cache:
+                reader = csv.reader(cache, delimiter=',')
+                for row in reader:
+                    if row:
+                        self.ids.add(row[0])
+            print('[ OK ] Loaded', len(self.ids), 'posts from', path)
+
+    def contains(self, id):
+        return id in self.ids
+
+    # Returns the subset of the given IDs that are already in the history
+    def find_posted(self, ids):
+        return self.ids.intersection(ids)
+
+    def log(self, id, post_url):
+        with open(self.path, 'a', newline='') as cache:
+            wr = csv.writer(cache, delimiter=',')
+            wr.writerow([id, get_post_date(), post_url])
+        self.ids.add(id)
+
+    # Saves several (id, post_url) rows with a single write
+    def log_all(self, entries):
+        date = get_post_date()
+        with open(self.path, 'a', newline='') as cache:
+            wr = csv.writer(cache, delimiter=',')
+            wr.writerows([id, date, post_url] for id, post_url in entries)
+        self.ids.update(id for id, post_url in entries)
+
+    def close(self):
+        return
+
+# Post history stored in a SQLite database, with an index on the Reddit post ID
+
+class SqliteHistory:
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS posts (id TEXT NOT NULL, date TEXT, post_url TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS posts_id ON posts (id)')
+        self.db.commit()
+
+    def contains(self, id):
+        row = self.db.execute('SELECT 1 FROM posts WHERE id = ? LIMIT 1', (id,)).fetchone()
+        return row is not None
+
+    # Returns the subset of the given IDs that are already in the history
+    def find_posted(self, ids):
+        ids = list(ids)
+        posted = set()
+        # Stay under the SQLite limit for query parameters
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            query = 'SELECT DISTINCT id FROM posts WHERE id IN (' + ','.join('?' * len(batch)) + ')'
+            posted.update(row[0] for row in self.db.execute(query, batch))
+        return posted
+
+    def log(self, id, post_url):
+        with self.db:
+            self.db.execute('INSERT INTO posts (id, date, post_url) VALUES (?, ?, ?)', (id, get_post_date(), post_url))
+
+    # Saves several (id, post_url) rows in a single transaction
+    def log_all(self, entries):
+        date = get_post_date()
+        with self.db:
+            self.db.executemany('INSERT INTO posts (id, date, post_url) VALUES (?, ?, ?)', [(id, date, post_url) for id, post_url in entries])
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM posts LIMIT 1').fetchone() is None
+
+    # One-time import of an existing cache spreadsheet
+    def import_csv(self, csv_path):
+        count = 0
+        with open(csv_path, 'rt', newline='') as cache:
+            reader = csv.reader(cache, delimiter=',')
+            rows = []
+            for row in reader:
+                # Skip the header row and anything malformed
+                if not row or row == CSV_HEADER:
+                    continue
+                row = (row + ['', ''])[:3]
+                rows.append(row)
+                count += 1
+        with self.db:
+            self.db.executemany('INSERT INTO posts (id, date, post_url) VALUES (?, ?, ?)', rows)
+        return count
+
+    def close(self):
+        self.db.close()
+
+# Post history stored in Redis, used by the Heroku version of Tootbot
+# Posted IDs are kept in one sorted set, scored by the time they were posted, and anything older than the retention window is trimmed
+# Memory use is about 100 bytes per post, so a bot posting 150 times a day with a 30 day window needs under 0.5MB
+# Takes an existing client, so the same connection pool is shared with the rest of the bot
+# Any redis-py compatible client works, including fakeredis.FakeRedis() for local testing
+
+class RedisHistory:
+
+    def __init__(self, client, key, retention):
+        self.redis = client
+        self.key = key
+        # Retention window, in seconds
+        self.retention = retention
+
+    # Runs a Redis command and reports how long it took
+    def timed(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        metrics.observe('redis', elapsed, command=name.split()[0])
+        print('[ OK ] Redis', name, 'took', '%.1f' % (elapsed * 1000), 'ms')
+        return result
+
+    def contains(self, id):
+        return id in self.find_posted([id])
+
+    # Returns the subset of the given IDs that are already in the history, using a single pipelined request
+    def find_posted(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.zscore(self.key, id)
+        # Older versions of Tootbot saved one key per post, so check for those too
+        pipe.mget(ids)
+        results = self.timed('pipeline (' + str(len(ids) + 1) + ' reads)', pipe.execute)
+        scores = results[:-1]
+        legacy = results[-1]
+        return set(id for id, score, value in zip(ids, scores, legacy) if score is not None or value)
+
+    def log(self, id, post_url):
+        self.log_all([(id, post_url)])
+
+    # Saves several posts with a single pipelined request, and trims posts older than the retention window
+    def log_all(self, entries):
+        if not entries:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.key, dict((id, now) for id, post_url in entries))
+        pipe.zremrangebyscore(self.key, '-inf', now - self.retention)
+        self.timed('pipeline (' + str(len(entries)) + ' writes)', pipe.execute)
+
+    def close(self):
+        return
+
+# Cache of Reddit posts that should not be looked at again for a while, with the reason why
+# Posts that were filtered out, queued or already posted are remembered until they fall out of the cache
+
+class NegativeCache:
+
+    def __init__(self, limit=1000):
+        self.limit = limit
+        # Reddit post ID -> (reason, expiry time)
+        self.entries = collections.OrderedDict()
+
+    # Returns the reason a post should be skipped, or None if it can be looked at
+    def check(self, id):
+        entry = self.entries.get(id)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return
+
+    # Remembers a post that should be skipped, for ttl seconds or until it falls out of the cache
+    def add(self, id, reason, ttl=None):
+        expires = float('inf') if ttl is None else time.time() + ttl
+        self.entries[id] = (reason, expires)
+        self.entries.move_to_end(id)
+        if len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+# Function for opening the post history with the backend selected in the config file
+
+def open_history(backend, csv_path, database_path):
+    if backend == 'csv':
+        return CsvHistory(csv_path)
+    elif backend == 'sqlite':
+        history = SqliteHistory(database_path)
+        # Import the old cache spreadsheet the first time the database is used
+        if history.is_empty() and os.path.exists(csv_path):
+            print('[ OK ] Importing post history from', csv_path, 'into', database_path + '...')
+            count = history.import_csv(csv_path)
+            print('[ OK ] Imported', count, 'posts into', database_path)
+        return history
+    else:
+        raise ValueError('Unknown cache backend: ' + backend)
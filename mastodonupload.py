@@ -0,0 +1,98 @@
+import os
+import time
+import requests
+import dateutil.parser
+from mastodon import MastodonAPIError
+from mastodon import MastodonNetworkError
+from mastodon import MastodonNotFoundError
+from mastodon import MastodonRatelimitError
+from mastodon import MastodonUnauthorizedError
+
+# Media uploads for Mastodon
+# Mastodon.py 1.3 uploads to /api/v1/media, which waits for videos to be processed before responding, so large videos often time out
+# /api/v2/media responds as soon as the file is received, and the attachment is checked until it is ready
+
+# Number of tries for each request, and the wait after the first failure
+MAX_ATTEMPTS = 4
+RETRY_DELAY = 2
+# Longest time to wait for the server to process a video
+PROCESSING_TIMEOUT = 300
+
+# Shared HTTP session, so the connection to the instance is reused between requests
+session = requests.Session()
+
+# Function for marking the rate limit of the Mastodon.py client as used up, so the bot waits for it the same way as for posts
+
+def set_ratelimit(api, response):
+    api.ratelimit_remaining = 0
+    try:
+        api.ratelimit_reset = dateutil.parser.parse(response.headers['X-RateLimit-Reset']).timestamp()
+    except (KeyError, ValueError, OverflowError):
+        api.ratelimit_reset = time.time() + 300
+
+# Function for sending a request to the instance, errors are raised the same way Mastodon.py raises them
+# Network errors and server errors are tried again, the request body is kept in memory so the file is only read once
+
+def upload_request(api, method, path, data=None, files=None):
+    headers = {'Authorization': 'Bearer ' + api.access_token}
+    error = None
+    for attempt in range(MAX_ATTEMPTS):
+        if error:
+            delay = RETRY_DELAY * 2 ** (attempt - 1)
+            print('[WARN] Mastodon upload failed (' + error + '), trying again in', delay, 'seconds')
+            time.sleep(delay)
+        try:
+            response = session.request(method, api.api_base_url + path, data=data, files=files, headers=headers, timeout=(10, 120))
+        except requests.RequestException as e:
+            error = str(e)
+            continue
+        if response.status_code >= 500:
+            error = 'status ' + str(response.status_code)
+            continue
+        if response.status_code == 429:
+            set_ratelimit(api, response)
+            raise MastodonRatelimitError('Mastodon media upload rate limit reached')
+        if response.status_code >= 400:
+            try:
+                message = response.json()['error']
+            except (ValueError, KeyError, TypeError):
+                message = response.reason
+            if response.status_code == 404:
+                raise MastodonNotFoundError('Mastodon API returned error', response.status_code, response.reason, message)
+            if response.status_code == 401:
+                raise MastodonUnauthorizedError('Mastodon API returned error', response.status_code, response.reason, message)
+            raise MastodonAPIError('Mastodon API returned error', response.status_code, response.reason, message)
+        return response
+    raise MastodonNetworkError('Mastodon upload failed after ' + str(MAX_ATTEMPTS) + ' tries: ' + error)
+
+# Function for uploading an image or video, returns the media attachment to pass to status_post()
+# The MIME type is passed in, since it was already worked out when the file was downloaded
+
+def upload_media(api, file_path, mime_type, description=None):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    start = time.time()
+    fields = {'description': description} if description else None
+    files = {'file': (os.path.basename(file_path), data, mime_type)}
+    try:
+        response = upload_request(api, 'POST', '/api/v2/media', data=fields, files=files)
+    except MastodonNotFoundError:
+        # Instances older than Mastodon 3.1.3 only have the v1 endpoint
+        response = upload_request(api, 'POST', '/api/v1/media', data=fields, files=files)
+    elapsed = max(time.time() - start, 0.001)
+    print('[ OK ] Uploaded', str(len(data) // 1024) + 'KB to Mastodon in', '%.1f' % elapsed, 'seconds (' + str(int(len(data) / 1024 / elapsed)) + 'KB/s)')
+    media = response.json()
+    # 202 means the file was received but is still being processed, and can't be attached to a post until it is done
+    if response.status_code == 202:
+        deadline = time.time() + PROCESSING_TIMEOUT
+        wait = 1
+        while media.get('url') is None:
+            if time.time() > deadline:
+                raise MastodonAPIError('Mastodon did not finish processing ' + file_path + ' in ' + str(PROCESSING_TIMEOUT) + ' seconds')
+            time.sleep(wait)
+            wait = min(wait * 2, 10)
+            response = upload_request(api, 'GET', '/api/v1/media/' + str(media['id']))
+            # The media endpoint returns 206 until processing has finished
+            media = response.json()
+        print('[ OK ] Mastodon finished processing', file_path, 'after', '%.1f' % (time.time() - start), 'seconds')
+    return media
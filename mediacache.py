@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import urllib.parse
+import metrics
+
+# Hosts that serve the same file no matter what query string is added to the URL
+STATIC_HOSTS = ('i.redd.it', 'i.imgur.com', 'media.giphy.com', 'i.giphy.com', 'thumbs.gfycat.com', 'giant.gfycat.com')
+
+# Function for turning a media URL into the key used by the cache, so small differences in a link don't cause a new download
+
+def canonical_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = parts.query
+    if host in STATIC_HOSTS:
+        query = ''
+    return urllib.parse.urlunsplit(('https', host, parts.path, query, ''))
+
+# Content-addressed media cache
+# Files are stored under the hash of their contents, so the same file linked from different URLs is only kept once
+# When the cache grows past its size limit, the least recently used files are deleted
+
+class MediaCache:
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        # Files that have been handed out and not released yet, these are never evicted
+        self.in_use = {}
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(folder, 'index.db'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)')
+        self.db.commit()
+
+    # Returns the path of the cached file for a URL, or None if it hasn't been downloaded before
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT files.hash, files.path FROM urls JOIN files ON urls.hash = files.hash WHERE urls.url = ?', (canonical_url(url),)).fetchone()
+            if row is None:
+                return
+            hash, path = row
+            if not os.path.exists(path):
+                # The file was deleted outside of the cache
+                self.remove(hash)
+                return
+            with self.db:
+                self.db.execute('UPDATE files SET last_used = ? WHERE hash = ?', (time.time(), hash))
+            self.use(path)
+            return path
+
+    # Moves a downloaded file into the cache, and returns its new path
+    def add(self, url, file_path, hash, extension):
+        path = os.path.join(self.folder, hash + extension)
+        with self.lock:
+            if os.path.exists(path):
+                # Another URL already downloaded the same file
+                os.remove(file_path)
+            else:
+                os.replace(file_path, path)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO files (hash, path, size, last_used) VALUES (?, ?, ?, ?)', (hash, path, os.path.getsize(path), time.time()))
+                self.db.execute('INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)', (canonical_url(url), hash))
+            self.use(path)
+            self.evict()
+        return path
+
+    def contains(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.folder)
+
+    def use(self, path):
+        self.in_use[path] = self.in_use.get(path, 0) + 1
+
+    # Marks a file as no longer needed, so it can be evicted later
+    def release(self, path):
+        with self.lock:
+            if self.in_use.get(path, 0) > 1:
+                self.in_use[path] -= 1
+            else:
+                self.in_use.pop(path, None)
+            self.evict()
+
+    # Deletes a file from the cache, for files that turned out to be unusable
+    def discard(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+            self.in_use.pop(path, None)
+            if row:
+                self.remove(row[0])
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def remove(self, hash):
+        row = self.db.execute('SELECT path FROM files WHERE hash = ?', (hash,)).fetchone()
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE hash = ?', (hash,))
+            self.db.execute('DELETE FROM urls WHERE hash = ?', (hash,))
+        if row and os.path.exists(row[0]):
+            os.remove(row[0])
+
+    # Deletes the least recently used files until the cache is under its size limit
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for hash, path, size in self.db.execute('SELECT hash, path, size FROM files ORDER BY last_used').fetchall():
+            if total <= self.max_size:
+                break
+            if path in self.in_use:
+                continue
+            self.remove(hash)
+            total -= size
+            print('[ OK ] Removed', path, 'from the media cache')
+
+# Cache for information looked up from media host APIs, like Imgur image links and Gfycat video URLs
+# Entries expire after ttl seconds, and are also saved to a SQLite database if a path is given, so they survive restarts
+
+class MetadataCache:
+
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+            with self.db:
+                self.db.execute('DELETE FROM metadata WHERE expires < ?', (time.time(),))
+            for key, value, expires in self.db.execute('SELECT key, value, expires FROM metadata'):
+                self.entries[key] = (json.loads(value), expires)
+
+    # Returns the cached value for a key, or None if it isn't cached or has expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.time():
+                self.hits += 1
+                metrics.count('cache_lookups', cache='metadata', result='hit')
+                return entry[0]
+            self.misses += 1
+            metrics.count('cache_lookups', cache='metadata', result='miss')
+            return
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            if self.db:
+                with self.db:
+                    self.db.execute('INSERT OR REPLACE INTO metadata (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expires))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import socketserver
+import http.server
+
+# Counters and timings for finding out where the time in each cycle goes
+# Everything is kept in memory, and can be read from an HTTP endpoint in the Prometheus text format or saved to a JSON file
+
+# (name, labels) -> value
+counters = {}
+# (name, labels) -> [number of times, total seconds, longest time]
+timings = {}
+lock = threading.Lock()
+start_time = time.time()
+
+def get_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+# Function for adding to a counter, labels are used to split it up (example: platform='twitter')
+
+def count(name, value=1, **labels):
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+# Function for recording how long something took, in seconds
+
+def observe(name, seconds, **labels):
+    key = get_key(name, labels)
+    with lock:
+        timing = timings.get(key)
+        if timing is None:
+            timing = timings[key] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+# Function for timing a block of code, used as 'with span(name):'
+# The time is recorded even if the block raises an error
+
+@contextlib.contextmanager
+def span(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+# Function for getting every counter and timing, in a form that can be saved as JSON
+
+def snapshot():
+    with lock:
+        return {
+            'time': time.time(),
+            'uptime': time.time() - start_time,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(counters.items())],
+            'timings': [{'name': name, 'labels': dict(labels), 'count': timing[0], 'seconds': timing[1], 'max_seconds': timing[2]} for (name, labels), timing in sorted(timings.items())]
+        }
+
+# Function for formatting the labels of a metric for Prometheus (example: {platform="twitter"})
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for key, value in labels) + '}'
+
+# Function for getting every counter and timing in the Prometheus text format
+# Timings are reported as summaries without quantiles, with the longest time as a separate gauge
+
+def get_prometheus_text():
+    lines = ['# TYPE tootbot_uptime_seconds gauge', 'tootbot_uptime_seconds ' + str(time.time() - start_time)]
+    with lock:
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            metric = 'tootbot_' + name + '_total'
+            if metric not in seen:
+                seen.add(metric)
+                lines.append('# TYPE ' + metric + ' counter')
+            lines.append(metric + format_labels(labels) + ' ' + str(value))
+        # Lines for each metric have to be kept together, so the longest times are listed after the summary
+        for timing_name in sorted(set(name for name, labels in timings)):
+            metric = 'tootbot_' + timing_name + '_seconds'
+            entries = [(labels, timing) for (name, labels), timing in sorted(timings.items()) if name == timing_name]
+            lines.append('# TYPE ' + metric + ' summary')
+            for labels, timing in entries:
+                lines.append(metric + '_count' + format_labels(labels) + ' ' + str(timing[0]))
+                lines.append(metric + '_sum' + format_labels(labels) + ' ' + str(timing[1]))
+            lines.append('# TYPE ' + metric + '_max gauge')
+            for labels, timing in entries:
+                lines.append(metric + '_max' + format_labels(labels) + ' ' + str(timing[2]))
+    return '\n'.join(lines) + '\n'
+
+# HTTP server for the metrics endpoint, each request is handled in its own thread so a slow client can't hold up the bot
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = get_prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests aren't logged, so they don't fill up the console
+    def log_message(self, format, *args):
+        return
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+# Function for saving the metrics to a JSON file
+# The file is written under a temporary name and then renamed, so readers never see half a file
+
+def save_json(file_path):
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(temp_path, file_path)
+
+def save_json_loop(file_path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            save_json(file_path)
+        except BaseException as e:
+            print('[EROR] Error while saving metrics:', str(e))
+
+# Function for turning on the metrics endpoint and/or the JSON file, both run in background threads
+# A port of 0 or an empty file path turns that output off
+
+def setup_metrics(port=0, file_path='', interval=60):
+    if port:
+        server = MetricsServer(('', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('[ OK ] Serving metrics at http://localhost:' + str(port) + '/metrics')
+    if file_path:
+        threading.Thread(target=save_json_loop, args=(file_path, interval), daemon=True).start()
+        print('[ OK ] Saving metrics to', file_path, 'every', interval, 'seconds')
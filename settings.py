@@ -0,0 +1,187 @@
+import os
+import configparser
+import distutils.util
+from typing import NamedTuple, Tuple
+
+# Settings for Tootbot, loaded once at startup and shared with the media and posting code
+# Settings can't be changed after loading, use _replace() to make a copy with different values
+
+class Settings(NamedTuple):
+    # General settings
+    cache_file: str
+    cache_backend: str
+    cache_database: str
+    queue_database: str
+    delay_between_posts: int
+    post_limit: int
+    listing_mode: str
+    subreddit_to_monitor: str
+    nsfw_posts_allowed: bool
+    spoilers_allowed: bool
+    self_posts_allowed: bool
+    hashtags: Tuple[str, ...]
+    dedup_retention_days: int
+    metrics_port: int
+    metrics_file: str
+    metrics_interval: int
+    # Settings related to media attachments
+    media_folder: str
+    media_posts_only: bool
+    media_workers: int
+    transcode_workers: int
+    ffmpeg_path: str
+    placeholder_hashes: Tuple[str, ...]
+    download_chunk_size: int
+    download_timeout: int
+    media_cache_size: int
+    metadata_cache_time: int
+    metadata_cache_file: str
+    # Twitter and Mastodon settings
+    post_to_twitter: bool
+    post_to_mastodon: bool
+    mastodon_instance_domain: str
+    mastodon_sensitive_media: bool
+    # Name of the bot, and the files its Twitter and Mastodon logins are saved in
+    name: str = 'default'
+    twitter_secret_file: str = 'twitter.secret'
+    mastodon_secret_file: str = 'mastodon.secret'
+    # API keys, filled in after the secret files are read in the local version
+    reddit_agent: str = ''
+    reddit_client_secret: str = ''
+    imgur_client: str = ''
+    imgur_client_secret: str = ''
+
+# MD5 hashes of known placeholder images, used when the setting isn't in the config file
+# Giphy's "This content is not available" GIF
+PLACEHOLDER_HASHES = '59a41d58693283c72d9da8ae0561e4e5'
+
+# Function for turning a 'true' or 'false' setting into a boolean
+
+def get_bool(value):
+    return bool(distutils.util.strtobool(value))
+
+# Function for turning a comma-separated list of hashtags into a tuple
+
+def get_hashtags(value):
+    if not value or value == 'false':
+        return ()
+    return tuple(x.strip() for x in value.split(','))
+
+# Function for creating settings from the keys of a config file section
+
+def get_section_settings(name, section):
+    return Settings(
+        cache_file=section['cachefile'],
+        cache_backend=section.get('cachebackend', 'sqlite'),
+        cache_database=section.get('cachedatabase', 'cache.db'),
+        queue_database=section.get('queuedatabase', 'queue.db'),
+        delay_between_posts=int(section['delaybetweenposts']),
+        post_limit=int(section['postlimit']),
+        listing_mode=section.get('listingmode', 'hot').lower(),
+        subreddit_to_monitor=section['subreddittomonitor'],
+        nsfw_posts_allowed=get_bool(section['nsfwpostsallowed']),
+        spoilers_allowed=get_bool(section['spoilersallowed']),
+        self_posts_allowed=get_bool(section['selfpostsallowed']),
+        hashtags=get_hashtags(section['hashtags']),
+        dedup_retention_days=int(section.get('dedupretentiondays', 30)),
+        metrics_port=int(section.get('metricsport', 0)),
+        metrics_file=section.get('metricsfile', ''),
+        metrics_interval=int(section.get('metricsinterval', 60)),
+        media_folder=section['mediafolder'],
+        media_posts_only=get_bool(section['mediapostsonly']),
+        media_workers=int(section.get('mediaworkers', 4)),
+        transcode_workers=int(section.get('transcodeworkers', 2)),
+        ffmpeg_path=section.get('ffmpegpath', 'ffmpeg'),
+        placeholder_hashes=get_list(section.get('placeholderhashes', PLACEHOLDER_HASHES)),
+        download_chunk_size=int(section.get('downloadchunksize', 1048576)),
+        download_timeout=int(section.get('downloadtimeout', 60)),
+        media_cache_size=int(section.get('mediacachesize', 500)),
+        metadata_cache_time=int(section.get('metadatacachetime', 86400)),
+        metadata_cache_file=section.get('metadatacachefile', 'metadata.db'),
+        post_to_twitter=get_bool(section['posttotwitter']),
+        post_to_mastodon=bool(section['instancedomain']),
+        mastodon_instance_domain=section['instancedomain'],
+        mastodon_sensitive_media=get_bool(section['sensitivemedia']),
+        name=name,
+        twitter_secret_file=section.get('twittersecretfile', 'twitter.secret'),
+        mastodon_secret_file=section.get('mastodonsecretfile', 'mastodon.secret')
+    )
+
+# Function for turning a comma-separated list into a tuple
+
+def get_list(value):
+    return tuple(x.strip() for x in value.split(',') if x.strip())
+
+# Function for loading settings from the config file, returns a list with the settings for each bot
+# The [BotSettings], [MediaSettings], [Twitter] and [Mastodon] sections set up the default bot
+# More bots are added with [BotSettings:name] sections, which only need the keys that are different from the default bot
+
+def load_config(path='config.ini'):
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(path + ' not found')
+    defaults = {}
+    for section in ('BotSettings', 'MediaSettings', 'Twitter', 'Mastodon'):
+        defaults.update(config[section])
+    bots = []
+    if defaults['subreddittomonitor']:
+        bots.append(get_section_settings('default', defaults))
+    for section in config.sections():
+        if not section.startswith('BotSettings:'):
+            continue
+        name = section.split(':', 1)[1].strip()
+        values = dict(defaults)
+        # Each bot has its own post history and logins, unless the section points at the same files
+        values['cachefile'] = name + '-cache.csv'
+        values['cachedatabase'] = name + '-cache.db'
+        values['twittersecretfile'] = name + '-twitter.secret'
+        values['mastodonsecretfile'] = name + '-mastodon.secret'
+        values.update(config[section])
+        bots.append(get_section_settings(name, values))
+    if not bots:
+        raise ValueError('SubredditToMonitor is not set')
+    return bots
+
+# Function for loading settings from environment variables, used by the Heroku version
+
+def load_environment():
+    env = os.environ
+    post_to_mastodon = get_bool(env.get('POST_TO_MASTODON', 'false'))
+    return Settings(
+        cache_file='',
+        cache_backend='redis',
+        cache_database='',
+        queue_database='',
+        delay_between_posts=int(env.get('DELAY_BETWEEN_POSTS', 600)),
+        post_limit=int(env.get('POST_LIMIT', 10)),
+        listing_mode=env.get('LISTING_MODE', 'hot').lower(),
+        subreddit_to_monitor=env.get('SUBREDDIT_TO_MONITOR', ''),
+        nsfw_posts_allowed=get_bool(env.get('NSFW_POSTS_ALLOWED', 'false')),
+        spoilers_allowed=get_bool(env.get('SPOILERS_ALLOWED', 'true')),
+        self_posts_allowed=get_bool(env.get('SELF_POSTS_ALLOWED', 'true')),
+        hashtags=get_hashtags(env.get('HASHTAGS', 'false')),
+        dedup_retention_days=int(env.get('DEDUP_RETENTION_DAYS', 30)),
+        metrics_port=int(env.get('METRICS_PORT', 0)),
+        metrics_file=env.get('METRICS_FILE', ''),
+        metrics_interval=int(env.get('METRICS_INTERVAL', 60)),
+        media_folder=env.get('MEDIA_FOLDER', 'media'),
+        media_posts_only=get_bool(env.get('MEDIA_POSTS_ONLY', 'false')),
+        media_workers=int(env.get('MEDIA_WORKERS', 4)),
+        transcode_workers=int(env.get('TRANSCODE_WORKERS', 2)),
+        ffmpeg_path=env.get('FFMPEG_PATH', 'ffmpeg'),
+        placeholder_hashes=get_list(env.get('PLACEHOLDER_HASHES', PLACEHOLDER_HASHES)),
+        download_chunk_size=int(env.get('DOWNLOAD_CHUNK_SIZE', 1048576)),
+        download_timeout=int(env.get('DOWNLOAD_TIMEOUT', 60)),
+        media_cache_size=int(env.get('MEDIA_CACHE_SIZE', 100)),
+        metadata_cache_time=int(env.get('METADATA_CACHE_TIME', 86400)),
+        # Heroku's file system is wiped on every restart, so lookups are only kept in memory
+        metadata_cache_file='',
+        post_to_twitter=get_bool(env.get('POST_TO_TWITTER', 'false')),
+        post_to_mastodon=post_to_mastodon,
+        mastodon_instance_domain=env.get('MASTODON_INSTANCE_DOMAIN', '') if post_to_mastodon else '',
+        mastodon_sensitive_media=get_bool(env.get('MASTODON_SENSITIVE_MEDIA', 'true')),
+        reddit_agent=env.get('REDDIT_AGENT', ''),
+        reddit_client_secret=env.get('REDDIT_SECRET', ''),
+        imgur_client=env.get('IMGUR_ID', ''),
+        imgur_client_secret=env.get('IMGUR_SECRET', '')
+    )
@@ -0,0 +1,33 @@
+import types
+import pytest
+from settings import get_section_settings
+
+# Settings and Reddit posts shared by the tests
+
+@pytest.fixture
+def make_settings(tmp_path):
+    def make_settings(twitter=True, mastodon=True, **changes):
+        settings = get_section_settings('test', {
+            'cachefile': str(tmp_path / 'cache.csv'),
+            'delaybetweenposts': '0',
+            'postlimit': '10',
+            'subreddittomonitor': 'test',
+            'nsfwpostsallowed': 'false',
+            'spoilersallowed': 'false',
+            'selfpostsallowed': 'false',
+            'hashtags': '',
+            'mediafolder': str(tmp_path),
+            'mediapostsonly': 'false',
+            'posttotwitter': 'true' if twitter else 'false',
+            'instancedomain': 'https://example.social' if mastodon else '',
+            'sensitivemedia': 'false'
+        })
+        return settings._replace(**changes)
+    return make_settings
+
+@pytest.fixture
+def make_submission():
+    def make_submission(id='abc', url=None):
+        return types.SimpleNamespace(id=id, url=url or 'https://example.com/' + id + '.jpg', title='Post ' + id,
+                                     shortlink='https://redd.it/' + id, over_18=False, media=None)
+    return make_submission
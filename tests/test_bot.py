@@ -0,0 +1,109 @@
+import time
+import asyncio
+import threading
+import concurrent.futures
+import bot
+import workqueue
+from bot import Bot
+from getmedia import MediaNotFoundError
+from history import SqliteHistory
+from workqueue import new_job
+from workqueue import SqliteWorkQueue
+
+# Tests for moving posts through the work queue, with downloads and posts replaced so nothing leaves the machine
+
+def make_bot(tmp_path, settings, name='test'):
+    return Bot(name, settings, SqliteHistory(str(tmp_path / (name + '-cache.db'))), SqliteWorkQueue(str(tmp_path / 'queue.db'), name))
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+def test_missing_media_is_not_downloaded_again(monkeypatch, tmp_path, make_settings, make_submission):
+    downloads = []
+    def get_media_files(submission, settings):
+        downloads.append(submission.id)
+        raise MediaNotFoundError('Imgur image not found')
+    monkeypatch.setattr(bot, 'get_gallery_urls', lambda submission, settings: [])
+    monkeypatch.setattr(bot, 'get_media_files', get_media_files)
+    test_bot = make_bot(tmp_path, make_settings())
+    job = new_job(make_submission('a'))
+    test_bot.queue.add(job)
+    # The post is made without media straight away, instead of after every retry
+    assert run(test_bot.prepare(job, None, None))
+    assert job['stage'] == 'post'
+    assert downloads == ['a']
+    assert test_bot.negative_cache.check('a') == 'media failed'
+
+def test_failed_conversion_is_retried_then_posted_without_media(monkeypatch, tmp_path, make_settings, make_submission):
+    media_file = tmp_path / 'a.mp4'
+    media_file.write_bytes(b'video')
+    monkeypatch.setattr(bot, 'get_gallery_urls', lambda submission, settings: [])
+    monkeypatch.setattr(bot, 'get_media_files', lambda submission, settings: (None, str(media_file)))
+    def get_twitter_media(media_file, hd_media_file, submission, settings):
+        raise OSError('ffmpeg crashed')
+    monkeypatch.setattr(bot, 'get_twitter_media', get_twitter_media)
+    test_bot = make_bot(tmp_path, make_settings())
+    job = new_job(make_submission('a'))
+    test_bot.queue.add(job)
+    assert not run(test_bot.prepare(job, None, None))
+    assert job['stage'] == 'transcode'
+    assert job['attempts'] == 1
+    assert job['retry_at'] > 0
+    for attempt in range(workqueue.MAX_ATTEMPTS - 1):
+        ready = run(test_bot.prepare(job, None, None))
+    assert ready
+    assert job['stage'] == 'post'
+    assert job['hd_media_file'] is None
+    assert job['replaced_files'] == [str(media_file)]
+
+def test_slow_media_does_not_hold_up_other_bots(monkeypatch, tmp_path, make_settings, make_submission):
+    media_ready = threading.Event()
+    def get_media_files(submission, settings):
+        if submission.id == 'slow':
+            media_ready.wait(10)
+        return None, None
+    monkeypatch.setattr(bot, 'get_gallery_urls', lambda submission, settings: [])
+    monkeypatch.setattr(bot, 'get_media_files', get_media_files)
+    bots = [make_bot(tmp_path, make_settings(), 'slow'), make_bot(tmp_path, make_settings(), 'fast')]
+    for test_bot in bots:
+        test_bot.queue.add(new_job(make_submission(test_bot.name)))
+        test_bot.post_to_twitter = test_bot.post_to_mastodon = lambda post_id, submission, media_files: ((post_id, 'posted'), True)
+    slow_bot, fast_bot = bots
+    # Runs cycles the way the main loop does, until nothing is left to post or the time runs out
+    def run_cycles(seconds):
+        deadline = time.time() + seconds
+        run(bot.run_cycle(bots, None, pool, pool, fetch=False))
+        while time.time() < deadline and any(test_bot.queue.jobs() for test_bot in bots):
+            run(bot.sleep_until(bots, deadline))
+            run(bot.run_cycle(bots, None, pool, pool, fetch=False))
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        start = time.time()
+        run_cycles(1)
+        # The other bot posts straight away, while the slow media is still being downloaded
+        assert fast_bot.history.contains('fast')
+        assert not slow_bot.history.contains('slow')
+        assert time.time() - start < 2
+        assert 'slow' in slow_bot.preparing
+        media_ready.set()
+        run_cycles(5)
+        assert slow_bot.history.contains('slow')
+        assert slow_bot.preparing == {}
+
+def test_posts_wait_for_the_delay_in_order(monkeypatch, tmp_path, make_settings, make_submission):
+    monkeypatch.setattr(bot, 'get_gallery_urls', lambda submission, settings: [])
+    monkeypatch.setattr(bot, 'get_media_files', lambda submission, settings: (None, None))
+    test_bot = make_bot(tmp_path, make_settings(delay_between_posts=3600))
+    test_bot.post_to_twitter = test_bot.post_to_mastodon = lambda post_id, submission, media_files: ((post_id, 'posted'), True)
+    for id in ('a', 'b'):
+        test_bot.queue.add(new_job(make_submission(id)))
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        deadline = time.time() + 5
+        run(test_bot.run(pool, pool))
+        while not test_bot.waiting and time.time() < deadline:
+            run(bot.sleep_until([test_bot], deadline))
+            run(test_bot.run(pool, pool))
+    assert test_bot.history.find_posted(['a', 'b']) == {'a'}
+    assert test_bot.waiting
+    # The second post is ready, so the main loop sleeps until the delay is over
+    assert [job['stage'] for job in test_bot.queue.jobs()] == ['post']
+    assert bot.get_wake_time([test_bot], time.time() + 7200) == test_bot.last_post_time + 3600
@@ -0,0 +1,125 @@
+import os
+import pytest
+import getmedia
+from imgurpython.helpers.error import ImgurClientError
+from mediacache import MediaCache
+from getmedia import find_resolver
+from getmedia import get_mime_type
+from getmedia import get_media_files
+
+# Tests for identifying, resolving and downloading media, run against a fake HTTP session so nothing is downloaded
+
+PNG_DATA = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+# Stand-in for the shared requests session, which always sends the same file
+
+class FakeSession:
+
+    def __init__(self, data, headers=None, status_code=200):
+        self.data = data
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.urls = []
+
+    def get(self, url, stream=False, timeout=None):
+        self.urls.append(url)
+        return FakeResponse(self)
+
+class FakeResponse:
+
+    def __init__(self, session):
+        self.status_code = session.status_code
+        self.headers = session.headers
+        self.data = session.data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size=1):
+        return iter([self.data[i:i + chunk_size] for i in range(0, len(self.data), chunk_size)])
+
+def test_get_mime_type_from_file_signature():
+    assert get_mime_type(b'\xff\xd8\xff\xe0' + b'\x00' * 8) == 'image/jpeg'
+    assert get_mime_type(PNG_DATA) == 'image/png'
+    assert get_mime_type(b'GIF89a' + b'\x00' * 6) == 'image/gif'
+    assert get_mime_type(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert get_mime_type(b'\x00\x00\x00\x20ftypisom\x00\x00\x02\x00') == 'video/mp4'
+    assert get_mime_type(b'\x00\x00\x00\x1cftypmp42\x00\x00\x00\x00') == 'video/mp4'
+    assert get_mime_type(b'<html>') is None
+    assert get_mime_type(b'') is None
+
+def test_get_mime_type_tells_mp4_apart_from_other_iso_media():
+    assert get_mime_type(b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00') == 'image/heic'
+    assert get_mime_type(b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00') == 'image/avif'
+    assert get_mime_type(b'\x00\x00\x00\x14ftypqt  \x00\x00\x02\x00') == 'video/quicktime'
+    assert get_mime_type(b'\x00\x00\x00\x14ftypcrx \x00\x00\x00\x01') is None
+
+def test_find_resolver_matches_host_and_parent_domains():
+    assert find_resolver('https://i.imgur.com/abc.gif') is getmedia.imgur_resolver
+    assert find_resolver('https://www.imgur.com/a/abc') is getmedia.imgur_resolver
+    assert find_resolver('https://V.REDD.IT/abc') is getmedia.reddit_video_resolver
+    assert find_resolver('https://i.redd.it/abc.jpg').name == 'Reddit image'
+    assert find_resolver('https://media.giphy.com/media/abc/giphy.gif').name == 'Giphy'
+    assert find_resolver('https://example.com/imgur.com/abc.jpg') is getmedia.generic_resolver
+    assert find_resolver('not a link') is getmedia.generic_resolver
+
+def test_resolve_media_skips_variants_the_host_does_not_have(monkeypatch):
+    calls = []
+    monkeypatch.setattr(getmedia, 'save_file', lambda *args, **kwargs: calls.append(args))
+    assert getmedia.resolve_media('https://i.redd.it/abc.jpg', 'twitter', None, None) is None
+    assert calls == []
+
+def test_failed_download_is_not_tried_again_for_twitter(monkeypatch, make_settings, make_submission):
+    urls = []
+    def save_file(url, file_path, max_size=None, allowed_types=None):
+        urls.append(url)
+    monkeypatch.setattr(getmedia, 'save_file', save_file)
+    monkeypatch.setattr(getmedia, 'has_ffmpeg', lambda: False)
+    settings = make_settings()
+    assert get_media_files(make_submission(url='https://example.com/missing.png'), settings) == (None, None)
+    assert urls == ['https://example.com/missing.png']
+
+def test_single_variant_host_is_downloaded_once_for_both_platforms(monkeypatch, tmp_path, make_settings, make_submission):
+    file_path = str(tmp_path / 'abc.jpg')
+    urls = []
+    def save_file(url, path, max_size=None, allowed_types=None):
+        urls.append(url)
+        return file_path
+    monkeypatch.setattr(getmedia, 'save_file', save_file)
+    # Without Mastodon or ffmpeg, the best version is still downloaded since Reddit images have no Twitter version
+    monkeypatch.setattr(getmedia, 'has_ffmpeg', lambda: False)
+    assert get_media_files(make_submission(url='https://i.redd.it/abc.jpg'), make_settings(mastodon=False)) == (file_path, file_path)
+    assert get_media_files(make_submission(url='https://i.redd.it/abc.jpg'), make_settings()) == (file_path, file_path)
+    assert urls == ['https://i.redd.it/abc.jpg'] * 2
+
+def test_link_without_file_name_gets_name_and_extension(monkeypatch, tmp_path, make_settings):
+    monkeypatch.setattr(getmedia, 'session', FakeSession(PNG_DATA))
+    file_path = getmedia.resolve_media('https://example.com/', 'hd', None, make_settings())
+    assert os.path.dirname(file_path) == str(tmp_path)
+    assert os.path.basename(file_path).startswith('media-')
+    assert file_path.endswith('.png')
+
+def test_cached_link_without_file_name_keeps_extension(monkeypatch, tmp_path, make_settings):
+    monkeypatch.setattr(getmedia, 'session', FakeSession(b'\x00' * 64, {'Content-Type': 'image/png'}))
+    monkeypatch.setattr(getmedia, 'media_cache', MediaCache(str(tmp_path / 'cache'), 1024 * 1024))
+    file_path = getmedia.resolve_media('https://example.com/dir/', 'hd', None, make_settings())
+    assert file_path.endswith('.png')
+
+def test_missing_imgur_image_is_a_permanent_failure(monkeypatch, make_settings):
+    def get_imgur_image(client, id):
+        raise ImgurClientError('Unable to find an image with the id, abc', 404)
+    monkeypatch.setattr(getmedia, 'get_imgur_client', lambda *args: object())
+    monkeypatch.setattr(getmedia, 'get_imgur_image', get_imgur_image)
+    with pytest.raises(getmedia.MediaNotFoundError):
+        getmedia.resolve_media('https://imgur.com/abc', 'hd', None, make_settings())
+
+def test_empty_imgur_album_has_no_media(monkeypatch, make_settings):
+    monkeypatch.setattr(getmedia, 'get_imgur_client', lambda *args: object())
+    monkeypatch.setattr(getmedia, 'get_imgur_album', lambda client, id: [])
+    assert getmedia.resolve_media('https://imgur.com/a/abc', 'hd', None, make_settings()) is None
+
+def test_invalid_link_has_no_media(make_settings):
+    assert getmedia.resolve_media('https://', 'hd', None, make_settings()) is None
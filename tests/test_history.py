@@ -0,0 +1,91 @@
+import csv
+import time
+import pytest
+import history
+from history import CSV_HEADER
+from history import NegativeCache
+from history import RedisHistory
+from history import SqliteHistory
+from history import open_history
+
+# Tests for the post history, the Redis ones run against fakeredis so no Redis server is needed
+
+def make_history(retention=3600):
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisHistory(fakeredis.FakeRedis(), 'tootbot:test', retention)
+
+def write_csv(path, rows):
+    with open(str(path), 'w', newline='') as cache:
+        csv.writer(cache).writerows(rows)
+
+def test_import_csv_skips_header_and_empty_rows(tmp_path):
+    write_csv(tmp_path / 'cache.csv', [CSV_HEADER, ['a', '01/01/2020 10:00:00', 'https://example.com/a'], [], ['b']])
+    sqlite_history = SqliteHistory(str(tmp_path / 'cache.db'))
+    assert sqlite_history.import_csv(str(tmp_path / 'cache.csv')) == 2
+    assert sqlite_history.find_posted(['a', 'b', 'c']) == {'a', 'b'}
+
+def test_open_history_imports_csv_only_once(tmp_path):
+    csv_path = str(tmp_path / 'cache.csv')
+    database_path = str(tmp_path / 'cache.db')
+    write_csv(csv_path, [CSV_HEADER, ['a', '01/01/2020 10:00:00', 'https://example.com/a']])
+    sqlite_history = open_history('sqlite', csv_path, database_path)
+    assert sqlite_history.contains('a')
+    sqlite_history.log('b', 'https://example.com/b')
+    sqlite_history.close()
+    # The spreadsheet is left alone once the database has posts in it
+    write_csv(csv_path, [CSV_HEADER, ['c', '01/01/2020 10:00:00', 'https://example.com/c']])
+    sqlite_history = open_history('sqlite', csv_path, database_path)
+    assert sqlite_history.find_posted(['a', 'b', 'c']) == {'a', 'b'}
+
+def test_open_history_rejects_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        open_history('mongodb', str(tmp_path / 'cache.csv'), str(tmp_path / 'cache.db'))
+
+def test_negative_cache_entries_expire(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(history.time, 'time', lambda: now)
+    negative_cache = NegativeCache()
+    negative_cache.add('a', 'spoiler', 60)
+    negative_cache.add('b', 'NSFW')
+    assert negative_cache.check('a') == 'spoiler'
+    monkeypatch.setattr(history.time, 'time', lambda: now + 120)
+    assert negative_cache.check('a') is None
+    assert negative_cache.check('b') == 'NSFW'
+
+def test_negative_cache_evicts_oldest_entries():
+    negative_cache = NegativeCache(limit=2)
+    negative_cache.add('a', 'queued')
+    negative_cache.add('b', 'queued')
+    # Adding an entry again moves it to the end, so it is kept
+    negative_cache.add('a', 'posted')
+    negative_cache.add('c', 'queued')
+    assert negative_cache.check('a') == 'posted'
+    assert negative_cache.check('b') is None
+    assert negative_cache.check('c') == 'queued'
+
+def test_find_posted_returns_logged_posts():
+    redis_history = make_history()
+    assert redis_history.find_posted(['a', 'b']) == set()
+    redis_history.log_all([('a', 'https://example.com/a'), ('b', 'https://example.com/b')])
+    assert redis_history.find_posted(['a', 'b', 'c']) == {'a', 'b'}
+    assert redis_history.contains('a')
+    assert not redis_history.contains('c')
+
+def test_find_posted_with_no_ids():
+    assert make_history().find_posted([]) == set()
+
+def test_find_posted_checks_legacy_keys():
+    redis_history = make_history()
+    # Older versions of Tootbot saved one key per post
+    redis_history.redis.set('old', 'https://example.com/old')
+    assert redis_history.find_posted(['old', 'new']) == {'old'}
+
+def test_log_all_trims_posts_older_than_retention(monkeypatch):
+    redis_history = make_history(retention=60)
+    now = time.time()
+    monkeypatch.setattr(history.time, 'time', lambda: now)
+    redis_history.log('old', 'https://example.com/old')
+    # The next write is after the retention window, so the first post is trimmed
+    monkeypatch.setattr(history.time, 'time', lambda: now + 120)
+    redis_history.log_all([('new', 'https://example.com/new')])
+    assert redis_history.find_posted(['old', 'new']) == {'new'}
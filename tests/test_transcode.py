@@ -0,0 +1,17 @@
+import subprocess
+import pytest
+import transcode
+from transcode import convert_video
+from transcode import TranscodeError
+
+# Tests for converting videos, with ffmpeg replaced so it doesn't have to be installed
+
+def test_long_video_is_not_converted(monkeypatch, tmp_path):
+    commands = []
+    monkeypatch.setattr(transcode, 'FFMPEG', 'ffmpeg')
+    monkeypatch.setattr(transcode, 'probe_video', lambda file_path: (600.0, True))
+    monkeypatch.setattr(subprocess, 'run', lambda command, **kwargs: commands.append(command))
+    # The video would have to be cut short to fit the limit, so it is skipped instead
+    with pytest.raises(TranscodeError):
+        convert_video(str(tmp_path / 'a.mp4'), str(tmp_path / 'a-twitter.mp4'), max_duration=140)
+    assert commands == []
@@ -0,0 +1,50 @@
+import pytest
+import workqueue
+from workqueue import fail_job
+from workqueue import new_job
+from workqueue import RedisWorkQueue
+from workqueue import SqliteWorkQueue
+
+# Tests for the work queue and retrying failed downloads
+
+def test_fail_job_backs_off_then_gives_up(monkeypatch, make_submission):
+    monkeypatch.setattr(workqueue.time, 'time', lambda: 1000)
+    job = new_job(make_submission())
+    delays = []
+    while fail_job(job, 'timeout'):
+        delays.append(job['retry_at'] - 1000)
+    assert delays == [workqueue.RETRY_DELAY * 2 ** n for n in range(workqueue.MAX_ATTEMPTS - 1)]
+    assert job['attempts'] == workqueue.MAX_ATTEMPTS
+
+def test_fail_job_does_not_retry_permanent_failures(make_submission):
+    job = new_job(make_submission())
+    assert not fail_job(job, 'not found', permanent=True)
+    assert job['retry_at'] == 0
+
+def test_sqlite_queue_keeps_order_and_skips_duplicates(tmp_path, make_submission):
+    queue = SqliteWorkQueue(str(tmp_path / 'queue.db'), 'test')
+    other_queue = SqliteWorkQueue(str(tmp_path / 'queue.db'), 'other')
+    for id in ('b', 'a', 'b'):
+        queue.add(new_job(make_submission(id)))
+    job = queue.jobs()[0]
+    job['stage'] = 'post'
+    queue.save(job)
+    assert [(job['post_id'], job['stage']) for job in queue.jobs()] == [('b', 'post'), ('a', 'resolve')]
+    assert queue.find_queued(['a', 'c']) == {'a'}
+    # Each bot only sees its own posts
+    assert other_queue.jobs() == []
+    queue.remove(job)
+    assert [job['post_id'] for job in queue.jobs()] == ['a']
+
+def test_redis_queue_adds_each_job_once(make_submission):
+    fakeredis = pytest.importorskip('fakeredis')
+    # fakeredis runs the Lua script with lupa
+    pytest.importorskip('lupa')
+    queue = RedisWorkQueue(fakeredis.FakeRedis(), 'tootbot:test')
+    for id in ('b', 'a', 'b'):
+        queue.add(new_job(make_submission(id)))
+    assert queue.redis.lrange(queue.list_key, 0, -1) == [b'b', b'a']
+    assert [job['post_id'] for job in queue.jobs()] == ['b', 'a']
+    assert queue.find_queued(['a', 'c']) == {'a'}
+    queue.remove(queue.jobs()[0])
+    assert [job['post_id'] for job in queue.jobs()] == ['a']
@@ -0,0 +1,154 @@
+import os
+import re
+import shutil
+import subprocess
+from PIL import Image
+
+# Path of the ffmpeg binary, set with setup_ffmpeg(), None if ffmpeg isn't installed
+FFMPEG = None
+
+# Limits for videos converted for Twitter
+# Twitter accepts larger and longer videos, but smaller files upload faster and are processed sooner
+TWITTER_VIDEO_MAX_SIZE = 15 * 1024 * 1024
+TWITTER_VIDEO_MAX_DURATION = 140
+TWITTER_VIDEO_MAX_WIDTH = 1280
+# Bitrates used for converted videos, in bits per second
+AUDIO_BITRATE = 128000
+MAX_VIDEO_BITRATE = 5000000
+MIN_VIDEO_BITRATE = 150000
+
+# Limits for recompressed images
+# Twitter and Mastodon scale down anything larger than this anyway
+IMAGE_MAX_DIMENSION = 4096
+IMAGE_QUALITY = 85
+IMAGE_MIN_QUALITY = 60
+
+# Error for videos that ffmpeg could not convert, or images that could not be made small enough
+
+class TranscodeError(Exception):
+    pass
+
+# Function for finding the ffmpeg binary, video conversion is turned off if it isn't installed
+
+def setup_ffmpeg(path='ffmpeg'):
+    global FFMPEG
+    FFMPEG = shutil.which(path) if path else None
+    if FFMPEG:
+        print('[ OK ] Using ffmpeg at', FFMPEG, 'to convert videos for Twitter')
+    else:
+        print('[WARN] ffmpeg not found, videos will be posted to Twitter as GIFs when possible')
+    return FFMPEG
+
+def has_ffmpeg():
+    return FFMPEG is not None
+
+# Function for getting the length of a video in seconds, and whether it has sound
+# ffmpeg prints information about the input file when it isn't given an output file
+
+def probe_video(file_path):
+    result = subprocess.run([FFMPEG, '-hide_banner', '-i', file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    m = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if not m:
+        raise TranscodeError('Could not read the length of ' + file_path)
+    duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    has_audio = re.search(r'Stream #.*: Audio:', result.stderr) is not None
+    return duration, has_audio
+
+# Function for converting a video or GIF to an H.264 MP4 that fits in max_size
+# The bitrate is worked out from the length of the video, and lowered again if the first try is still too large
+# Videos longer than max_duration are not converted, instead of cutting off the end
+
+def convert_video(source, file_path, max_size=TWITTER_VIDEO_MAX_SIZE, max_duration=TWITTER_VIDEO_MAX_DURATION):
+    if not FFMPEG:
+        raise TranscodeError('ffmpeg is not installed')
+    duration, has_audio = probe_video(source)
+    if duration > max_duration:
+        raise TranscodeError('Video is longer than ' + str(max_duration) + ' seconds (' + str(int(duration)) + ' seconds)')
+    duration = max(duration, 1)
+    audio_bitrate = AUDIO_BITRATE if has_audio else 0
+    # Leave 5% of the file size for the MP4 container
+    video_bitrate = min(int(max_size * 8 * 0.95 / duration) - audio_bitrate, MAX_VIDEO_BITRATE)
+    for attempt in range(3):
+        if video_bitrate < MIN_VIDEO_BITRATE:
+            raise TranscodeError('Video is too long to fit in ' + str(max_size // (1024 * 1024)) + 'MB')
+        command = [
+            FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', source,
+            # Width and height have to be even numbers for yuv420p
+            '-vf', "scale='trunc(min(" + str(TWITTER_VIDEO_MAX_WIDTH) + ",iw)/2)*2':-2",
+            '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'high', '-pix_fmt', 'yuv420p',
+            '-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2),
+            # Put the index at the start of the file, so it can be played while it's still loading
+            '-movflags', '+faststart'
+        ]
+        if has_audio:
+            command += ['-c:a', 'aac', '-b:a', str(AUDIO_BITRATE), '-ac', '2']
+        else:
+            command += ['-an']
+        command.append(file_path)
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise TranscodeError('ffmpeg failed: ' + result.stderr.strip()[-500:])
+        size = os.path.getsize(file_path)
+        if size <= max_size:
+            print('[ OK ] Converted', source, 'to', file_path, '(' + str(size // 1024) + 'KB)')
+            return file_path
+        # Try again with a lower bitrate, scaled by how far over the limit the file was
+        video_bitrate = int(video_bitrate * max_size / size * 0.9)
+    os.remove(file_path)
+    raise TranscodeError('Converted video is still larger than ' + str(max_size // (1024 * 1024)) + 'MB')
+
+# Function for combining a video-only and an audio-only MP4 into one file
+# The streams are copied as they are, so this takes about as long as copying the files
+
+def mux_video(video, audio, file_path):
+    if not FFMPEG:
+        raise TranscodeError('ffmpeg is not installed')
+    command = [
+        FFMPEG, '-hide_banner', '-loglevel', 'error', '-y', '-i', video, '-i', audio,
+        '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-shortest', '-movflags', '+faststart', file_path
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise TranscodeError('ffmpeg failed: ' + result.stderr.strip()[-500:])
+    print('[ OK ] Added audio to', video, 'as', file_path, '(' + str(os.path.getsize(file_path) // 1024) + 'KB)')
+    return file_path
+
+# Function for checking if an image has transparency, which would be lost by saving it as a JPEG
+
+def has_transparency(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+# Function for shrinking a JPEG, PNG or WebP image that is larger than max_size, by scaling it down and recompressing it
+# The image is saved as a JPEG, or a PNG if it has transparency, and the file extension is added to file_path
+# JPEG files are decoded at a reduced size with Image.draft(), so the full-size image never has to be held in memory
+
+def shrink_image(source, file_path, max_size):
+    with Image.open(source) as img:
+        width, height = img.size
+        transparent = has_transparency(img)
+    file_path += '.png' if transparent else '.jpg'
+    # The file size goes with the number of pixels, so the sides are scaled by the square root of how far over the limit the file is
+    scale = min(1.0, (max_size / os.path.getsize(source)) ** 0.5, IMAGE_MAX_DIMENSION / max(width, height))
+    quality = IMAGE_QUALITY
+    for attempt in range(5):
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        with Image.open(source) as img:
+            img.draft('RGB', size)
+            img.thumbnail(size, Image.LANCZOS)
+            if transparent:
+                img.save(file_path, 'PNG', optimize=True)
+            else:
+                img.convert('RGB').save(file_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        file_size = os.path.getsize(file_path)
+        if file_size <= max_size:
+            print('[ OK ] Shrunk', source, 'to', file_path, '(' + str(size[0]) + 'x' + str(size[1]) + ', ' + str(file_size // 1024) + 'KB)')
+            return file_path
+        # Try again smaller, and with lower quality
+        scale *= min(0.9, (max_size / file_size) ** 0.5)
+        quality = max(IMAGE_MIN_QUALITY, quality - 10)
+    os.remove(file_path)
+    raise TranscodeError('Image is still larger than ' + str(max_size // 1024) + 'KB after shrinking')
@@ -0,0 +1,67 @@
+import os
+import time
+import requests
+import tweepy
+
+# Chunked media uploads for Twitter
+# Tweepy 3.7 can only upload media in a single request, which doesn't work for videos
+
+UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+# Twitter accepts up to 5MB in each APPEND request
+CHUNK_SIZE = 4 * 1024 * 1024
+# Longest time to wait for Twitter to process a video
+PROCESSING_TIMEOUT = 300
+
+# Shared HTTP session, so the connection to the upload server is reused between requests
+session = requests.Session()
+
+# Function for sending a request to the upload endpoint, errors are raised the same way Tweepy raises them
+
+def upload_request(auth, method, params=None, data=None, files=None):
+    response = session.request(method, UPLOAD_URL, params=params, data=data, files=files, auth=auth, timeout=(10, 120))
+    if response.status_code >= 400:
+        message = 'Twitter upload failed with status ' + str(response.status_code)
+        api_code = None
+        try:
+            error = response.json()['errors'][0]
+            message = error['message']
+            api_code = error.get('code')
+        except (ValueError, KeyError, IndexError, TypeError):
+            pass
+        raise tweepy.TweepError(message, response, api_code=api_code)
+    return response
+
+# Function for uploading a video in chunks with the INIT, APPEND, FINALIZE and STATUS commands
+# Returns the media ID to attach to a tweet, once Twitter has finished processing the video
+
+def upload_video(api, file_path, media_type='video/mp4'):
+    # OAuth 1 signing from the Tweepy client, so no separate login is needed
+    auth = api.auth.apply_auth()
+    response = upload_request(auth, 'POST', data={
+        'command': 'INIT',
+        'media_type': media_type,
+        'total_bytes': os.path.getsize(file_path),
+        'media_category': 'tweet_video'
+    })
+    media_id = response.json()['media_id_string']
+    with open(file_path, 'rb') as f:
+        segment = 0
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            upload_request(auth, 'POST', data={'command': 'APPEND', 'media_id': media_id, 'segment_index': segment}, files={'media': chunk})
+            segment += 1
+    response = upload_request(auth, 'POST', data={'command': 'FINALIZE', 'media_id': media_id})
+    # Videos are processed after uploading, and can't be attached to a tweet until that is done
+    info = response.json().get('processing_info')
+    deadline = time.time() + PROCESSING_TIMEOUT
+    while info and info['state'] in ('pending', 'in_progress'):
+        if time.time() > deadline:
+            raise tweepy.TweepError('Twitter did not finish processing ' + file_path + ' in ' + str(PROCESSING_TIMEOUT) + ' seconds', response)
+        time.sleep(info.get('check_after_secs', 5))
+        response = upload_request(auth, 'GET', params={'command': 'STATUS', 'media_id': media_id})
+        info = response.json().get('processing_info')
+    if info and info['state'] == 'failed':
+        raise tweepy.TweepError('Twitter could not process the video: ' + info.get('error', {}).get('message', 'unknown error'), response)
+    return media_id
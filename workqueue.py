@@ -0,0 +1,158 @@
+import json
+import time
+import sqlite3
+import types
+
+# Stages a post goes through after it is discovered on Reddit, in order
+STAGES = ('resolve', 'transcode', 'post', 'log')
+
+# Fields of a Reddit submission kept in the queue, enough to download its media and make the post without asking Reddit again
+SUBMISSION_FIELDS = ('id', 'url', 'title', 'shortlink', 'over_18', 'media')
+# Fields that Reddit only sends for some submissions, like galleries, these are read without making PRAW fetch the submission again
+OPTIONAL_SUBMISSION_FIELDS = ('gallery_data', 'media_metadata')
+
+# Number of times media is downloaded or converted before the post is made without it, and the wait after the first failure
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 300
+
+# Function for creating a job for a Reddit submission
+
+def new_job(submission):
+    fields = dict((field, getattr(submission, field)) for field in SUBMISSION_FIELDS)
+    fields.update((field, vars(submission).get(field)) for field in OPTIONAL_SUBMISSION_FIELDS)
+    return {
+        'post_id': submission.id,
+        'stage': 'resolve',
+        'submission': fields,
+        # Media for the first attachment, for Twitter and Mastodon
+        'media_file': None,
+        'hd_media_file': None,
+        # Link of the first attachment for galleries, and [link, media_file, hd_media_file] for each of the others
+        'media_url': None,
+        'gallery': [],
+        # Downloaded files that were replaced by a converted version, deleted after posting
+        'replaced_files': [],
+        # Failed downloads and conversions, and the time the next try can start
+        'attempts': 0,
+        'retry_at': 0,
+        # Platform name -> [post history entry, whether the post was made], saved as each platform finishes
+        'results': {}
+    }
+
+# Function for turning the saved submission fields back into an object with the same attributes as a PRAW submission
+
+def get_submission(job):
+    return types.SimpleNamespace(**job['submission'])
+
+# Function for getting every attachment of a job for one platform, field is 'media_file' or 'hd_media_file'
+
+def get_media_list(job, field):
+    index = 1 if field == 'media_file' else 2
+    return [f for f in [job[field]] + [item[index] for item in job.get('gallery', [])] if f]
+
+# Function for recording a failed download or conversion, returns True if the job should be tried again later
+# Permanent failures, like media that was deleted, are never tried again
+
+def fail_job(job, reason, permanent=False):
+    job['attempts'] += 1
+    if permanent or job['attempts'] >= MAX_ATTEMPTS:
+        return False
+    delay = RETRY_DELAY * 2 ** (job['attempts'] - 1)
+    job['retry_at'] = time.time() + delay
+    print('[WARN] Trying', job['post_id'], 'again in', delay, 'seconds (attempt', str(job['attempts']) + ' of ' + str(MAX_ATTEMPTS) + '):', reason)
+    return True
+
+# Work queue stored in a SQLite database, one row per post that hasn't been logged yet
+# Several bots can share the same database, each one only sees its own posts
+
+class SqliteWorkQueue:
+
+    def __init__(self, path, bot):
+        self.path = path
+        self.bot = bot
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, bot TEXT NOT NULL, post_id TEXT NOT NULL, stage TEXT, data TEXT, UNIQUE (bot, post_id))')
+        self.db.commit()
+
+    # Adds a job, unless the post is already in the queue
+    def add(self, job):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO jobs (bot, post_id, stage, data) VALUES (?, ?, ?, ?)', (self.bot, job['post_id'], job['stage'], json.dumps(job)))
+
+    def save(self, job):
+        with self.db:
+            self.db.execute('UPDATE jobs SET stage = ?, data = ? WHERE bot = ? AND post_id = ?', (job['stage'], json.dumps(job), self.bot, job['post_id']))
+
+    def remove(self, job):
+        with self.db:
+            self.db.execute('DELETE FROM jobs WHERE bot = ? AND post_id = ?', (self.bot, job['post_id']))
+
+    # Returns every job in the order it was added
+    def jobs(self):
+        return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM jobs WHERE bot = ? ORDER BY seq', (self.bot,))]
+
+    # Returns the subset of the given IDs that are already in the queue
+    def find_queued(self, ids):
+        ids = list(ids)
+        queued = set()
+        # Stay under the SQLite limit for query parameters
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            query = 'SELECT post_id FROM jobs WHERE bot = ? AND post_id IN (' + ','.join('?' * len(batch)) + ')'
+            queued.update(row[0] for row in self.db.execute(query, [self.bot] + batch))
+        return queued
+
+    def close(self):
+        self.db.close()
+
+# Lua script for adding a job to the Redis work queue, if it isn't already there
+ADD_JOB_SCRIPT = '''
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+'''
+
+# Work queue stored in Redis, used by the Heroku version of Tootbot
+# The order of the jobs is kept in a Redis list, and the jobs themselves in a hash keyed by Reddit post ID
+
+class RedisWorkQueue:
+
+    def __init__(self, client, key):
+        self.redis = client
+        self.list_key = key + ':order'
+        self.hash_key = key + ':jobs'
+        self.add_script = self.redis.register_script(ADD_JOB_SCRIPT)
+
+    # Adds a job, unless the post is already in the queue
+    # The job and its place in the order are saved together by a script, so a crash can't leave one without the other
+    def add(self, job):
+        self.add_script(keys=[self.hash_key, self.list_key], args=[job['post_id'], json.dumps(job)])
+
+    def save(self, job):
+        self.redis.hset(self.hash_key, job['post_id'], json.dumps(job))
+
+    def remove(self, job):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hdel(self.hash_key, job['post_id'])
+        pipe.lrem(self.list_key, 0, job['post_id'])
+        pipe.execute()
+
+    # Returns every job in the order it was added
+    def jobs(self):
+        ids = self.redis.lrange(self.list_key, 0, -1)
+        if not ids:
+            return []
+        return [json.loads(data) for data in self.redis.hmget(self.hash_key, ids) if data]
+
+    # Returns the subset of the given IDs that are already in the queue
+    def find_queued(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hexists(self.hash_key, id)
+        return set(id for id, exists in zip(ids, pipe.execute()) if exists)
+
+    def close(self):
+        return